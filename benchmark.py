@@ -0,0 +1,240 @@
+"""End-to-end cycle-time benchmark for the delivery and return missions.
+
+Runs the real mission code against esp_simulator.py on pseudo-terminals and
+mongomock in place of the Mongo server, in real time:
+
+    python benchmark.py --runs 3
+    python benchmark.py --compare
+
+mongomock cannot run the server-side order operations (`$[]` updates, `$merge`,
+transactions), so order-document steps are skipped unless --mongo-uri points
+at a throwaway local mongod.
+
+Every run is appended to benchmarks/results.jsonl with the current commit so
+later runs can be compared against it.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from mission import (
+    ORDER_ACTIONS, SimulatedMissionRunner, SimulatedRobot, load_motion_model, load_rack, without_actions,
+)
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "results.jsonl")
+
+# How each step's time is accounted: actually moving, waiting on a fixed
+# delay, or talking to the database. A parallel step counts as what its
+# longest branch does (see categorize).
+STEP_CATEGORIES = {
+    "goto": "moving", "wait_arrival": "moving",
+    "chassis": "idle", "gripper": "idle", "sleep": "idle",
+    "order_status": "db", "robot_status": "db", "sku_status": "db", "archive_order": "db",
+}
+
+
+def describe(step):
+    if step["action"] == "parallel":
+        return "parallel " + " | ".join("; ".join(describe(inner) for inner in branch) for branch in step["branches"])
+    details = [str(value) for key, value in step.items() if key not in ("action", "timeout", "wait")]
+    if step.get("wait") is False:
+        details.append("(no wait)")
+    return f"{step['action']} {' '.join(details)}".strip()
+
+
+def categorize(steps, start):
+    """The category of each step. A parallel step takes the category of the
+    step its longest branch spends most time on, with branches timed on a
+    simulated robot that follows the route from `start`."""
+    rack = load_rack()
+    robot = SimulatedRobot(rack["speeds"], rack["chassis_switch_time"], load_motion_model())
+    robot.position = dict(zip("xyz", start))
+    runner = SimulatedMissionRunner(robot, clock=robot.clock)
+    categories = []
+    for step in steps:
+        if step["action"] != "parallel":
+            runner.run([step])
+            categories.append(STEP_CATEGORIES[step["action"]])
+            continue
+        started = robot.now
+        branches = []
+        for branch in step["branches"]:
+            robot.now = started
+            branches.append((runner.run(branch), robot.now))
+        timings, robot.now = max(branches, key=lambda branch: branch[1])
+        if not timings:
+            categories.append("idle")
+            continue
+        longest, _ = max(timings, key=lambda timing: timing[1])
+        categories.append(STEP_CATEGORIES[longest["action"]])
+    return categories
+
+
+def start_environment(mongo_uri=None):
+    from esp_simulator import SimulatedBoards
+
+    # mongomock and --mongo-uri ignore the credentials, but connect() requires them
+    os.environ.setdefault("MONGO_USER", "benchmark")
+    os.environ.setdefault("MONGO_PASS", "benchmark")
+    from mongo_db_driver import DbController
+
+    rack = load_rack()
+    boards = SimulatedBoards(rack["speeds"], telemetry_hz=20.0, chassis_time=rack["chassis_switch_time"]).start()
+    os.environ.update(boards.env())
+    clients = []
+    if mongo_uri:
+        import pymongo
+        connect = pymongo.MongoClient
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("The benchmark needs mongomock as a local Mongo stand-in: pip install mongomock")
+        connect = mongomock.MongoClient
+
+    def client_factory(uri, **options):
+        clients.append(connect(mongo_uri or uri, **options))
+        return clients[-1]
+
+    DbController.client_factory = staticmethod(client_factory)
+    # A scratch outbox, so writes queued by a real deployment are not replayed into the benchmark,
+    # and a fleet of just the simulated robot
+    scratch = tempfile.mkdtemp(prefix="benchmark-")
+    DbController.outbox_path = os.path.join(scratch, "outbox.sqlite3")
+    os.environ["FLEET_FILE"] = os.path.join(scratch, "fleet.json")
+
+    # Imported late: the module reads the port settings and builds the DB when loaded
+    import demo_with_db
+    demo_with_db.db.connect()
+    service = next(iter(demo_with_db.controllers.values()))
+    service.robot.start()
+    service.robot.initialize_positions()
+    return boards, service, clients[0].ecom
+
+
+def seed_order(ecom, order_id, cell_id):
+    ecom.robots.update_one({"robot_id": "1"}, {"$set": {"status": "IDLE"}}, upsert=True)
+    ecom.orders.insert_one({
+        "_id": order_id,
+        "status": "NEW",
+        "created_at": datetime.now(timezone.utc),
+        "item_list": [{"sku": "BENCH", "status": "NEW", "cell": cell_id}],
+    })
+
+
+def summarize(mission, cell_id, start, timings, total):
+    categories = categorize([step for step, _ in timings], start)
+    steps = [
+        {"step": describe(step), "category": category, "duration": round(duration, 3)}
+        for (step, duration), category in zip(timings, categories)
+    ]
+    totals = {"moving": 0.0, "idle": 0.0, "db": 0.0}
+    for step in steps:
+        totals[step["category"]] += step["duration"]
+    return {
+        "mission": mission,
+        "cell": cell_id,
+        "total": round(total, 3),
+        "moving": round(totals["moving"], 3),
+        "idle": round(totals["idle"], 3),
+        "db": round(totals["db"], 3),
+        "orders_per_hour": round(3600.0 / total, 2) if total else None,
+        "steps": steps,
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result, verbose):
+    if verbose:
+        for step in result["steps"]:
+            print(f"  {step['duration']:8.2f}s  {step['category']:<6}  {step['step']}")
+    print(
+        f"{result['mission']:<8} cell {result['cell']}: total {result['total']:.1f}s, "
+        f"moving {result['moving']:.1f}s, idle {result['idle']:.1f}s, db {result['db']:.2f}s, "
+        f"{result['orders_per_hour']} orders/hour"
+    )
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(path):
+    # Latest run per mission against the latest run of the same mission from another commit
+    results = load_results(path)
+    for mission in sorted({result["mission"] for result in results}):
+        runs = [result for result in results if result["mission"] == mission]
+        latest = runs[-1]
+        baseline = next((run for run in reversed(runs) if run["commit"] != latest["commit"]), None)
+        if baseline is None:
+            print(f"{mission}: only runs from {latest['commit']}, nothing to compare")
+            continue
+        delta = latest["total"] - baseline["total"]
+        print(
+            f"{mission}: {baseline['total']:.1f}s @ {baseline['commit']} -> "
+            f"{latest['total']:.1f}s @ {latest['commit']} ({delta:+.1f}s, {delta / baseline['total']:+.1%})"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark delivery and return missions against the simulator")
+    parser.add_argument("--runs", type=int, default=1, help="Delivery/return cycles to run")
+    parser.add_argument("--delivery-cell", default="A1")
+    parser.add_argument("--return-cell", default="B1")
+    parser.add_argument("--mongo-uri", help="Use this MongoDB (its ecom database is written to) instead of mongomock")
+    parser.add_argument("--output", default=RESULTS_FILE, help="JSON lines file results are appended to")
+    parser.add_argument("--compare", action="store_true", help="Compare the saved results and exit")
+    parser.add_argument("--verbose", action="store_true", help="Print per-step timings")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.output)
+        return
+
+    boards, service, ecom = start_environment(args.mongo_uri)
+    skipped = () if args.mongo_uri else ORDER_ACTIONS
+    commit = current_commit()
+    results = []
+    try:
+        for run in range(args.runs):
+            order_id = f"bench-{int(time.time())}-{run}"
+            seed_order(ecom, order_id, args.delivery_cell)
+            for mission, cell_id in (("delivery", args.delivery_cell), ("return", args.return_cell)):
+                # From where the last mission left the robot, as the service plans it
+                steps, start = service.route_from_here(mission, cell_id)
+                steps = without_actions(steps, skipped)
+                started = time.monotonic()
+                timings = service.missions.run(steps, order_id)
+                result = summarize(mission, cell_id, start, timings, time.monotonic() - started)
+                result.update(commit=commit, timestamp=time.time(), run=run)
+                print_result(result, args.verbose)
+                results.append(result)
+    finally:
+        service.robot.close()
+        boards.stop()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "a") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    print(f"Saved {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
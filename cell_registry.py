@@ -0,0 +1,79 @@
+import logging
+import threading
+
+
+class CellRegistry:
+    """Rack layout indexed by cell ID, loaded once at startup.
+
+    Built from rack.json: cells, stations (fixed points such as the port) and
+    per-shelf lift heights, which are resolved into each cell when it is
+    indexed so that a lookup is a single dict access. Cells may also carry the
+    SKUs stored in them, indexed for cell_for_sku(). Updates from a Mongo
+    `cells` collection (see DbController.watch_cells) replace entries in place
+    and notify `listeners` with the changed cell ID.
+    """
+
+    def __init__(self, layout):
+        self.shelves = layout.get("shelves", {})
+        self.stations = layout.get("stations", {})
+        # Rack-wide route parameters; station fields are flattened as <station>_<field>
+        self.params = {key: value for key, value in layout.items() if not isinstance(value, (dict, list))}
+        for name, station in self.stations.items():
+            self.params.update({f"{name}_{field}": value for field, value in station.items()})
+        self.listeners = []
+        self._cells = {}
+        self._skus = {}
+        self._lock = threading.Lock()
+        for cell_id, cell in layout.get("cells", {}).items():
+            self._index(cell_id, cell)
+
+    def _index(self, cell_id, cell):
+        resolved = dict(self.shelves.get(str(cell.get("shelf")), {}))
+        resolved.update({key: value for key, value in cell.items() if key not in ("_id", "skus")})
+        old = self._cells.get(cell_id)
+        if old is not None:
+            for sku in old.get("skus", ()):
+                self._skus.pop(sku, None)
+        resolved["skus"] = tuple(cell.get("skus", ()))
+        self._cells[cell_id] = resolved
+        for sku in resolved["skus"]:
+            self._skus[sku] = cell_id
+
+    def get(self, cell_id):
+        return self._cells.get(cell_id)
+
+    def ids(self):
+        return list(self._cells)
+
+    def cell_for_sku(self, sku):
+        return self._skus.get(sku)
+
+    def location(self, name):
+        """A named coordinate: "home_x", a station field such as "port.z" or a
+        cell field such as "A1.buffer_y"."""
+        place, _, field = name.partition(".")
+        if not field:
+            return self.params[name]
+        entry = self._cells.get(place) or self.stations.get(place)
+        if entry is None or field not in entry:
+            raise KeyError(f"Unknown location {name}")
+        return entry[field]
+
+    def update(self, cell_id, cell):
+        with self._lock:
+            self._index(cell_id, cell)
+        self._changed(cell_id)
+
+    def remove(self, cell_id):
+        with self._lock:
+            old = self._cells.pop(cell_id, None)
+            for sku in (old or {}).get("skus", ()):
+                self._skus.pop(sku, None)
+        self._changed(cell_id)
+
+    def _changed(self, cell_id):
+        for listener in self.listeners:
+            try:
+                listener(cell_id)
+            except Exception as e:
+                logging.error('Cell registry listener failed for %s: %s', cell_id, e)
@@ -1,264 +1,392 @@
-import serial
+import os
+import threading
 import time
-from flask import Flask, request
 
+from flask import Flask, Response, jsonify, request
+from pymongo.errors import PyMongoError
+
+from fleet import RESERVATION_TIMEOUT, CellReservations, Dispatcher, load_fleet
+from job_queue import JobQueue
+from live_stream import DEFAULT_INTERVAL, LiveState
+from metrics import MISSION_DURATION, Gauge, render
+from mission import (
+    ORDER_ACTIONS, MissionRunner, RouteError, cell_registry, compile_route, compiled_route, estimated_cycle_time,
+    home_position, load_route, port_position, rack_grid, route_aisles, route_end, without_actions,
+)
 from mongo_db_driver import DbController
+from repositioning import PARK_DELAY, Repositioner, first_stop
+from serial_transport import HOMING_TIMEOUT, CommandFailed, MotionTimeout, RobotLink
+from startup import RETRY_INTERVAL, Startup
+
+# Cells used when a request does not name one (see rack.json)
+DEFAULT_DELIVERY_CELL = "A1"
+DEFAULT_RETURN_CELL = "B1"
+DEFAULT_CELLS = {"delivery": DEFAULT_DELIVERY_CELL, "return": DEFAULT_RETURN_CELL}
+
+def make_recorder(robot_id=None):
+    # RECORD_TELEMETRY=1 records every session under recordings/ (needs numpy)
+    if not os.environ.get('RECORD_TELEMETRY'):
+        return None
+    from recorder import RECORDINGS_DIR, Recorder
+    if robot_id is None:
+        return Recorder()
+    return Recorder(os.path.join(RECORDINGS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-robot{robot_id}"))
 
-ESP32_PORT = '/dev/ttyUSB0'
-ARDUINO_PORT = '/dev/ttyUSB1'
-BAUD_RATE_ESP = 19200
-BAUD_RATE_NANO = 9600
-TIMEOUT = 1
-
-try:
-    esp32_serial = serial.Serial(ESP32_PORT, BAUD_RATE_ESP, timeout=TIMEOUT)
-    nano_serial = serial.Serial(ARDUINO_PORT, BAUD_RATE_NANO, timeout=TIMEOUT)
-    print(f"Connected to ESP32 on {ESP32_PORT}")
-    print(f"Connected to NANO on {ARDUINO_PORT}")
-except Exception as e:
-    print(f"Error initializing serial port: {e}")
-    exit()
-
-current_pos_x = 0.0
-current_pos_y = 0.0
-current_pos_z = 0.0
     
 app = Flask(__name__)
 db = DbController()
-def initialize_positions():
-    global current_pos_x, current_pos_y, current_pos_z
-    i = 0
-    time.sleep(2)
-    while i<5:
-        
-        initial_data = read_esp32_data()
-        if initial_data:
-            current_pos_x, current_pos_y, current_pos_z = initial_data
-            print(f"Initialized positions - X: {current_pos_x}, Y: {current_pos_y}, Z: {current_pos_z}")
-        else:
-            print("Failed to initialize positions. Using default values.")
-        i += 1
-    
-    return current_pos_x, current_pos_y, current_pos_z
-        
-def send_nano_command(command):
-    try:
-        if nano_serial.is_open:
-            nano_serial.write((command + '\n').encode('utf-8'))
-            print(f"Sent command to Nano: {command}")
-        else:
-            print("Nano serial port is not open.")
-    except Exception as e:
-        print(f"Error sending command to Nano: {e}")
-        
-# Function to send a movement command
-def send_movement_command(direction, distance):
-    global current_pos_x, current_pos_y, current_pos_z
-    cmd = ""
-    if direction == "forward":
-        current_pos_x += distance
-        cmd = f"MOVX,{current_pos_x:.4f}"
-    elif direction == "backward":
-        current_pos_x -= distance
-        cmd = f"MOVX,{current_pos_x:.4f}"
-
-    elif direction == "left":
-        current_pos_y += distance
-        cmd = f"MOVY,{current_pos_y:.4f}"
-
-    elif direction == "right":
-        current_pos_y -= distance
-        cmd = f"MOVY,{current_pos_y:.4f}"
-
-    elif direction == "up":
-        current_pos_z += distance
-        cmd = f"LIFT,{current_pos_z:.4f}"
-
-    elif direction == "down":
-        current_pos_z -= distance
-        cmd = f"LIFT,{current_pos_z:.4f}"
-
-    if cmd:
-        try:
-            esp32_serial.write((cmd + '\n').encode())
-            print(f"Sent to ESP32: {cmd}")
-        except Exception as e:
-            print(f"Error sending to ESP32: {e}")
-
-def change_chassis(chassis_command):
-    # Map chassis command to the corresponding POLO command
-    chassis_map = {
-        "stable": "POLO,0",
-        "x": "POLO,1",
-        "y": "POLO,2"
+reservations = CellReservations()
+db_ready = threading.Event()
+
+
+def order_cells(order):
+    # Items name their cell or are looked up by SKU in the registry; anything
+    # unknown comes from the default cell, as before batching
+    registry = cell_registry()
+    cells = {
+        item.get("cell") or registry.cell_for_sku(item.get("sku")) or DEFAULT_DELIVERY_CELL
+        for item in order.get("item_list", [])
     }
-    
-    if chassis_command not in chassis_map:
-        print(f"Invalid chassis command: {chassis_command}")
-        return
+    return cells or {DEFAULT_DELIVERY_CELL}
 
-    # Send the chassis command to the ESP32
-    command = chassis_map[chassis_command]
-    esp32_serial.write((command + '\n').encode())
-    print(f"Sent chassis command: {command}")
 
-    # Wait for 1.5 seconds to allow the chassis change to complete
-    print("Waiting for chassis change to complete...")
-    time.sleep(2)
-    print("Chassis change completed.")
+def wait_for_db():
+    if not db_ready.wait(RETRY_INTERVAL):
+        raise ConnectionError("Mongo not ready")
 
 
-def read_esp32_data():
+class RobotController:
+    """One robot of the fleet: its boards, telemetry, missions and job queue.
+
+    `params` replace rack-wide route parameters for this robot (its home).
+    Only a robot that is alone on the rack parks at a hot spot while idle. In a
+    fleet a robot drives back to its own home after every job, since it holds
+    the aisle it stands in and a spot on the way to the port would block the
+    other robots (see fleet.py).
+    """
+
+    def __init__(self, robot_id, esp32, nano, params=None, solo=True):
+        self.robot_id = robot_id
+        self.solo = solo
+        self.overrides = tuple(sorted((params or {}).items()))
+        self.robot = RobotLink(esp32, nano, recorder=make_recorder(None if solo else robot_id), registry=cell_registry())
+        self.live = LiveState(self.robot.telemetry)
+        self.missions = MissionRunner(self.robot, db, on_robot_status=self.live.set_status, robot_id=robot_id)
+        self.repositioner = Repositioner(self.robot, self.overrides)
+        self.jobs = JobQueue(
+            handlers={
+                "delivery": lambda order_id, **params: self.run_mission(self.delivery_logic, order_id, **params),
+                "return": lambda order_id, **params: self.run_mission(self.return_logic, order_id, **params),
+                "batch_delivery": lambda order_ids: self.run_mission(self.batch_delivery_logic, order_ids),
+            },
+            # Cycle times in seconds (per trip to a cell for batches) from the motion model, refined as jobs complete
+            estimated_durations={
+                "delivery": estimated_cycle_time("delivery", DEFAULT_DELIVERY_CELL),
+                "return": estimated_cycle_time("return", DEFAULT_RETURN_CELL),
+                "batch_delivery": estimated_cycle_time("delivery", DEFAULT_DELIVERY_CELL),
+            },
+            on_idle=(lambda: self.run_mission(self.park_logic, None)) if solo else None,
+            idle_delay=PARK_DELAY,
+            robot_id=robot_id,
+        )
+        # Jobs are accepted right away and run once this robot and the database are up
+        self.startup = Startup(on_ready=self.jobs.start)
+        self.startup.add("serial", self.connect_boards).add("homing", self.home_robot).add("db", wait_for_db)
+
+    def start(self):
+        self.robot.start()
+        self.startup.start()
+
+    def connect_boards(self):
+        if not self.robot.wait_connected(HOMING_TIMEOUT):
+            raise ConnectionError("ESP32 or Nano not connected")
+
+    def home_robot(self):
+        if self.robot.initialize_positions() is None:
+            raise TimeoutError("no position frame from the ESP32")
+        reservations.stand(self.robot_id, rack_grid().aisles_at(self.repositioner.start()[:2]), RESERVATION_TIMEOUT)
+
+    def route_from_here(self, name, cell_id):
+        # Compiled from where the last job left the robot, not from home
+        start = self.repositioner.start()
+        steps = compiled_route(name, cell_id, start, self.overrides)
+        self.repositioner.record(steps, start)
+        return steps, start
+
+    def home_route(self, steps, start):
+        # Steps back to this robot's home after `steps`; none for a robot alone on the rack
+        if self.solo:
+            return ()
+        end = route_end(steps, start)
+        home = home_position(self.overrides)
+        if end == home[:2]:
+            return ()
+        params = dict(cell_registry().params, **dict(self.overrides), park_x=home[0], park_y=home[1])
+        return compile_route(load_route("park"), params, rack_grid(), end + home[2:], "stable")
+
+    def drive(self, steps, start, order_id=None, then_home=True):
+        # Hold every aisle on the way, then the ones the robot ends up standing in
+        if then_home:
+            steps = tuple(steps) + self.home_route(steps, start)
+        aisles, standing = route_aisles(steps, start)
+        with reservations.hold(self.robot_id, aisles, standing, RESERVATION_TIMEOUT):
+            return self.missions.run(steps, order_id)
+
+    def can_start(self, kind, cell_id=None):
+        # Whether every aisle the job would need is free for this robot right now
+        if kind not in DEFAULT_CELLS:
+            return True
+        try:
+            start = self.repositioner.start()
+        except RouteError:
+            return False
+        steps = compiled_route(kind, cell_id or DEFAULT_CELLS[kind], start, self.overrides)
+        aisles, _ = route_aisles(steps + self.home_route(steps, start), start)
+        return reservations.available(self.robot_id, aisles)
+
+    def travel_time(self, kind, cell_id=None):
+        # Seconds from where the robot is to where the job first needs it
+        if kind not in DEFAULT_CELLS:
+            return 0.0
+        try:
+            start = self.repositioner.start()
+        except RouteError:
+            # Needs re-homing before it can take any job
+            return float("inf")
+        stop = first_stop(compiled_route(kind, cell_id or DEFAULT_CELLS[kind], start, self.overrides), start)
+        return 0.0 if stop == start[:2] else rack_grid().plan(start[:2], stop)[1]
+
+    def return_logic(self, order_id, cell_id=DEFAULT_RETURN_CELL):
+        return self.drive(*self.route_from_here("return", cell_id), order_id)
+
+    def delivery_logic(self, order_id, cell_id=DEFAULT_DELIVERY_CELL):
+        return self.drive(*self.route_from_here("delivery", cell_id), order_id)
+
+    def park_logic(self, order_id=None):
+        # Wait for the next job at the spot recent jobs have needed the robot most
+        start = self.repositioner.start()
+        steps = self.repositioner.park_route()
+        if steps:
+            self.drive(steps, start)
+
+    def batch_delivery_logic(self, order_ids):
+        orders = db.get_orders_by_ids(order_ids)
+        missing = [order_id for order_id in order_ids if order_id not in orders]
+        if missing:
+            print(f"Orders not found, skipping: {missing}")
+        if not orders:
+            # Fail the job rather than finish it in no time and skew the ETAs
+            raise LookupError(f"None of the orders {order_ids} were found")
+
+        # Orders whose items share a cell are served by a single trip to that box
+        cells = set()
+        for order in orders.values():
+            cells |= order_cells(order)
+
+        # Compile every visit before touching the orders, so a cell the route cannot
+        # serve fails the job with the orders as they were. Each delivery ends at
+        # the port, so every visit after the first starts there; only the first
+        # depends on the order, so it goes to the cell closest to the robot.
+        start = self.repositioner.start()
+        visits = []
+        for cell_id in sorted(cells, key=lambda cell_id: (self.travel_time("delivery", cell_id), cell_id)):
+            steps = without_actions(compiled_route("delivery", cell_id, start, self.overrides), ORDER_ACTIONS)
+            visits.append((start, steps))
+            start = port_position()
+
+        db.update_orders_status_by_ids(orders, "IN_PROCESS")
+        for number, (start, steps) in enumerate(visits, 1):
+            self.repositioner.record(steps, start)
+            # The next visit was compiled from the port, so home only after the last
+            self.drive(steps, start, then_home=number == len(visits))
+        for order_id in orders:
+            db.set_sku_in_order_status_by_id(order_id, "DELIVERED")
+        db.update_orders_status_by_ids(orders, "ALL_SET")
+
+    def run_mission(self, mission, order_id, **params):
+        name = mission.__name__.replace("_logic", "")
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            mission(order_id, **params)
+            outcome = "ok"
+        except (MotionTimeout, CommandFailed) as e:
+            outcome = "aborted"
+            print(f"Robot {self.robot_id} mission aborted: {e}")
+            db.update_robot_status("ERROR", self.robot_id)
+            self.live.set_status("ERROR")
+            raise
+        finally:
+            MISSION_DURATION.labels(name, outcome).observe(time.monotonic() - started)
 
-    try:
-        if esp32_serial.in_waiting > 0:
-            response = esp32_serial.readline().decode('utf-8', errors='ignore').strip()
-            if response:
-                print(f"Raw data received: {response}")  # Debug raw data
-                return parse_esp32_data(response.strip())
-    except serial.SerialException as e:
-        print(f"Serial error: {e}")
-        
-def parse_esp32_data(response):
-    try:
-        if response.startswith("AK80"):
-            parts = response[5:].split(',')
 
-            if len(parts) == 4:  # Expecting 4 parts now (3 positions and the flag)
-                pos_x = round(float(parts[0].strip()), 2)
-                pos_y = round(float(parts[1].strip()), 2)
-                pos_z = round(float(parts[2].strip()), 2)
-                stopped_by_sensor = int(parts[3].strip())  # Parse the flag as an integer
+fleet = load_fleet()
+controllers = {
+    robot["robot_id"]: RobotController(
+        robot["robot_id"], robot["esp32"], robot["nano"], robot.get("params"), solo=len(fleet) == 1,
+    )
+    for robot in fleet
+}
+dispatcher = Dispatcher(controllers)
 
-                # print(f"Parsed Data - pos_x: {pos_x}, pos_y: {pos_y}, pos_z: {pos_z}, stopped_by_sensor: {stopped_by_sensor}")
-                return pos_x, pos_y, pos_z
 
+def requested_controller():
+    # The robot named by ?robot=, or None when the request does not name one
+    robot_id = request.args.get('robot')
+    if robot_id is None:
+        return None
+    if robot_id not in controllers:
+        raise ValueError(f"Unknown robot {robot_id}")
+    return controllers[robot_id]
+
+
+def submit_job(kind):
+    order_id = request.args.get('order_id')
+    if not order_id:
+        return jsonify({"error": "order_id is required"}), 400
+    params = {}
+    if request.args.get('cell'):
+        params["cell_id"] = request.args.get('cell')
+        try:
+            compiled_route(kind, params["cell_id"])
+        except RouteError as e:
+            return jsonify({"error": str(e)}), 400
+    try:
+        controller = requested_controller() or dispatcher.choose(kind, params.get("cell_id"))
     except ValueError as e:
-        print(f"Error converting data to float: {e}")
-    except Exception as e:
-        print(f"Error parsing ESP32 data: {e}")
-    return None
-
-
-def return_logic(order_id):
-    db.archivate_order(order_id)
-    send_movement_command("down", 1.22)
-    time.sleep(7)
-    db.update_robot_status("TAKING_THE_BOX")
-    send_nano_command("release")
-    time.sleep(9)
-    send_nano_command("grasp")
-    send_movement_command("up", 1.22)
-    time.sleep(16)
-    db.update_robot_status("MOVING_TO_CELL")
-    change_chassis("x")
-    send_movement_command("forward", 652)
-    time.sleep(6)
-    change_chassis("stable")
-    send_movement_command("down", 1.75)
-    time.sleep(20)
-    db.update_robot_status("RELEASING_THE_BOX")
-    send_nano_command("release")
-    send_movement_command("up", 1.75)
-    time.sleep(4)
-    send_nano_command("grasp")
-    db.update_robot_status("IDLE")
-
- 
-def delivery_logic(order_id):
-    # Execute delivery steps
-    # time.sleep(5)
-    db.update_order_status_by_id(order_id,"IN_PROCESS")
-    db.update_robot_status("MOVING_TO_CELL")
-    change_chassis("x")
-    send_movement_command("forward", 652)
-    time.sleep(6)
-    change_chassis("y")
-    send_movement_command("left", 1677)
-    time.sleep(9)
-    change_chassis("x")
-    send_movement_command("forward", 2545)
-    time.sleep(12)
-    change_chassis("stable")
-    send_movement_command("down", 1.35)
-    time.sleep(7)
-    db.update_robot_status("GETTING_THE_BOX")
-    send_nano_command("release")
-    time.sleep(10)
-    send_nano_command("grasp")
-    send_movement_command("up", 1.35)
-    time.sleep(17)
-    change_chassis("y")
-    send_movement_command("right", 853)
-    time.sleep(7)
-    change_chassis("stable")
-    send_movement_command("down", 1.75)
-    time.sleep(21)
-    send_nano_command("release")
-    send_movement_command("up", 1.75)
-    time.sleep(4)
-    send_nano_command("grasp")
-    time.sleep(17)
-    change_chassis("y")
-    send_movement_command("left", 851)
-    time.sleep(7)
-    change_chassis("stable")
-    send_movement_command("down", 1.75)
-    time.sleep(7)
-    send_nano_command("release")
-    time.sleep(14)
-    send_nano_command("grasp")
-    send_movement_command("up", 1.75)
-    time.sleep(21)
-    db.update_robot_status("MOVING_HOME")
-    change_chassis("x")
-    send_movement_command("backward", 2552)
-    time.sleep(12)
-    change_chassis("y")
-    send_movement_command("right", 1688)
-    time.sleep(9)
-    change_chassis("x")
-    send_movement_command("backward", 638)
-    time.sleep(6)
-    change_chassis("stable")
-    send_movement_command("down", 1.22)
-    time.sleep(16)
-    db.update_robot_status("RELEASING_THE_BOX")
-    send_nano_command("release")
-    send_movement_command("up", 1.22)
-    time.sleep(4)
-    send_nano_command("grasp")
-    time.sleep(12)
-    db.update_robot_status("IDLE")
-    db.set_sku_in_order_status_by_id(order_id, "DELIVERED")
-    db.update_order_status_by_id(order_id, "ALL_SET")
+        return jsonify({"error": str(e)}), 400
+    job = controller.jobs.submit(kind, order_id, params)
+    return jsonify(controller.jobs.describe(job)), 202
 
 
-    
-    
-    
-    
-    
 @app.route('/delivery', methods=['GET'])
 def delivery_flask():
-        print("Executing delivery logic...")
-        order_id = request.args.get('order_id')
-        delivery_logic(order_id)
-        return "Success"
+        print("Queueing delivery logic...")
+        return submit_job("delivery")
 
 @app.route('/return', methods=['GET'])
 def return_flask():
-        print("Executing return logic...")
-        order_id = request.args.get('order_id')
-        return_logic(order_id)
-        return "Success"
+        print("Queueing return logic...")
+        return submit_job("return")
+
+@app.route('/batch_delivery', methods=['GET'])
+def batch_delivery_flask():
+        print("Queueing batch delivery logic...")
+        order_ids = [order_id for order_id in request.args.get('order_ids', '').split(',') if order_id]
+        if not order_ids:
+            return jsonify({"error": "order_ids is required"}), 400
+        try:
+            controller = requested_controller() or dispatcher.choose("batch_delivery")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        job = controller.jobs.submit("batch_delivery", order_ids, size=batch_trips(order_ids))
+        return jsonify(controller.jobs.describe(job)), 202
+
+def batch_trips(order_ids):
+    # A batch makes one trip per distinct cell, which is what its ETA scales with;
+    # without the database yet, assume one trip per order
+    if not db_ready.is_set():
+        return len(order_ids)
+    try:
+        orders = db.get_orders_by_ids(order_ids)
+    except PyMongoError:
+        return len(order_ids)
+    return max(len(set().union(*(order_cells(order) for order in orders.values()))), 1)
+
+def current_positions():
+    positions = {}
+    for robot_id, controller in controllers.items():
+        snapshot = controller.robot.telemetry.latest
+        if snapshot is not None:
+            positions.update({(robot_id, axis): getattr(snapshot, axis) for axis in "xyz"})
+    return positions
+
+
+Gauge(
+    "robot_job_queue_depth", "Jobs waiting or running.", ["robot"],
+    callback=lambda: {(robot_id,): controller.jobs.depth() for robot_id, controller in controllers.items()},
+)
+Gauge("robot_position", "Last reported position per axis.", ["robot", "axis"], callback=current_positions)
+Gauge("robot_mongo_outbox_depth", "Database writes waiting for Mongo to come back.", callback=lambda: {(): db.outbox_depth()})
+
+
+@app.route('/stream', methods=['GET'])
+def stream_flask():
+        # Server-Sent Events: position and status, at most one message per `interval` seconds
+        try:
+            interval = float(request.args.get('interval', DEFAULT_INTERVAL))
+        except ValueError:
+            return jsonify({"error": "interval must be a number"}), 400
+        try:
+            controller = requested_controller() or next(iter(controllers.values()))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return Response(
+            controller.live.subscribe(interval),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+@app.route('/metrics', methods=['GET'])
+def metrics_flask():
+        return render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+def connect_db():
+    # The client and network round-trips happen here, not when DbController() is
+    # built at import, so a missing setting shows on /ready instead of killing the service
+    db.connect()
+    db.ensure_indexes()
+    db.watch_cells(cell_registry())
+    db.start_write_behind()
+
+
+startup = Startup(on_ready=db_ready.set).add("db", connect_db)
+
+
+@app.route('/ready', methods=['GET'])
+def ready_flask():
+        robots = {
+            robot_id: {"ready": controller.startup.ready(), "subsystems": controller.startup.status()}
+            for robot_id, controller in controllers.items()
+        }
+        ready = startup.ready() and all(robot["ready"] for robot in robots.values())
+        return jsonify({"ready": ready, "subsystems": startup.status(), "robots": robots}), 200 if ready else 503
+
+@app.route('/reservations', methods=['GET'])
+def reservations_flask():
+        # Aisle -> robot currently working it
+        return jsonify(reservations.snapshot())
+
+@app.route('/orders/pending', methods=['GET'])
+def pending_orders_flask():
+        # The order queue as the scheduler sees it: oldest first, with the cells to visit
+        try:
+            limit = int(request.args.get('limit', 0))
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+        return jsonify([
+            {"order_id": order["_id"], "status": order.get("status"), "cells": sorted(order_cells(order))}
+            for order in db.get_pending_orders(limit)
+        ])
+
+@app.route('/jobs', methods=['GET'])
+def jobs_flask():
+        robots = {robot_id: controller.jobs.snapshot() for robot_id, controller in controllers.items()}
+        return jsonify({"depth": sum(robot["depth"] for robot in robots.values()), "robots": robots})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_flask(job_id):
+        for controller in controllers.values():
+            job = controller.jobs.get(job_id)
+            if job is not None:
+                return jsonify(controller.jobs.describe(job))
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
            
 if __name__ == "__main__":
-    current_pos_x = 0.0
-    current_pos_y = 0.0
-    current_pos_z = 0.0
-    initialize_positions()
-    app.run(host='0.0.0.0', port=5000)
+    startup.start()
+    for controller in controllers.values():
+        controller.start()
+    app.run(host='0.0.0.0', port=5000, threaded=True)
     # print("Press Enter to execute delivery logic...")
     # while True:
     #     user_input = input("\nPress Enter to start or type 'exit' to quit: ")
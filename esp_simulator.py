@@ -0,0 +1,221 @@
+"""ESP32 / Nano simulator over pseudo-terminals.
+
+Run it, then start any of the scripts with the printed port variables:
+
+    python esp_simulator.py
+    ESP32_PORT=/dev/pts/5 ARDUINO_PORT=/dev/pts/7 python demo_with_db.py
+"""
+import argparse
+import os
+import select
+import threading
+import time
+import tty
+
+from telemetry import BINARY_ACCEPTED, BINARY_HANDSHAKE, encode_binary_frame
+
+CHASSIS_MODES = {"0": "stable", "1": "x", "2": "y"}
+AXIS_COMMANDS = {"MOVX": "x", "MOVY": "y", "LIFT": "z"}
+NANO_COMMANDS = ("grasp", "release", "fix", "unfix")
+
+
+def open_pty():
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    # Like a real UART, frames are dropped rather than blocking when nobody reads
+    os.set_blocking(master, False)
+    return master, slave, os.ttyname(slave)
+
+
+class Axis:
+    def __init__(self, speed):
+        self.speed = speed
+        self.start = 0.0
+        self.target = 0.0
+        self.started_at = 0.0
+
+    def position(self, now):
+        travelled = max(now - self.started_at, 0.0) * self.speed
+        if travelled >= abs(self.target - self.start):
+            return self.target
+        return self.start + travelled * (1 if self.target > self.start else -1)
+
+    def move(self, target, now):
+        self.start = self.position(now)
+        self.target = target
+        self.started_at = now
+
+
+class Esp32Simulator:
+    """Accepts MOVX/MOVY/LIFT/POLO lines and reports AK80 frames.
+
+    Commands take effect `latency` seconds after they arrive. Moves issued while
+    the chassis is still switching start once the switch completes. With
+    `acks`, answers the ACKS,1 handshake and acknowledges `@<seq>,` commands.
+    With `binary`, answers TELB,1 and sends binary frames from then on.
+    """
+
+    def __init__(self, speeds, telemetry_hz=10.0, latency=0.05, chassis_time=1.5, acks=True, binary=True):
+        self.axes = {axis: Axis(speed) for axis, speed in speeds.items()}
+        self.telemetry_interval = 1.0 / telemetry_hz
+        self.latency = latency
+        self.chassis_time = chassis_time
+        self.chassis = "stable"
+        self.chassis_ready_at = 0.0
+        self.acks = acks
+        self.binary = binary
+        self.binary_frames = False
+        self.commands = []
+        self.last_seq = None
+
+    def handle(self, line, now):
+        # Returns the line to answer with, if any
+        if self.acks and line == "ACKS,1":
+            return "ACK,0"
+        if self.binary and line == BINARY_HANDSHAKE:
+            self.binary_frames = True
+            return BINARY_ACCEPTED
+        if self.acks and line.startswith("@"):
+            seq, _, line = line[1:].partition(",")
+            if seq == self.last_seq:
+                # A resend after a lost ACK: already executed
+                return f"ACK,{seq}"
+            error = self.execute(line, now)
+            if error:
+                return f"NAK,{seq},{error}"
+            self.last_seq = seq
+            return f"ACK,{seq}"
+        error = self.execute(line, now)
+        if error:
+            print(f"[sim esp32] {error}: {line}")
+        return None
+
+    def execute(self, line, now):
+        self.commands.append((now, line))
+        name, _, value = line.partition(",")
+        try:
+            if name in AXIS_COMMANDS:
+                self.axes[AXIS_COMMANDS[name]].move(float(value), max(now, self.chassis_ready_at))
+            elif name == "POLO" and value in CHASSIS_MODES:
+                if CHASSIS_MODES[value] != self.chassis:
+                    self.chassis = CHASSIS_MODES[value]
+                    self.chassis_ready_at = now + self.chassis_time
+            else:
+                return "Unknown command"
+        except ValueError:
+            return "Bad value"
+        return None
+
+    def frame(self, now):
+        x, y, z = (self.axes[axis].position(now) for axis in "xyz")
+        if self.binary_frames:
+            return encode_binary_frame(x, y, z)
+        return f"AK80,{x:.4f},{y:.4f},{z:.4f},0\n".encode()
+
+
+class NanoSimulator:
+    def __init__(self):
+        self.gripper = None
+        self.commands = []
+
+    def handle(self, line, now):
+        self.commands.append((now, line))
+        if line in NANO_COMMANDS:
+            self.gripper = line
+        else:
+            print(f"[sim nano] Unknown command: {line}")
+        return None
+
+
+class SimulatedBoards:
+    """Serves both simulated boards on their own pty pair from one thread."""
+
+    def __init__(self, speeds, telemetry_hz=10.0, latency=0.05, chassis_time=1.5, acks=True, binary=True):
+        self.esp32 = Esp32Simulator(speeds, telemetry_hz, latency, chassis_time, acks, binary)
+        self.nano = NanoSimulator()
+        self._esp32_master, self._esp32_slave, self.esp32_port = open_pty()
+        self._nano_master, self._nano_slave, self.nano_port = open_pty()
+        self._buffers = {self._esp32_master: b"", self._nano_master: b""}
+        self._pending = []
+        self._running = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="board-simulator", daemon=True)
+
+    def start(self):
+        self._running.set()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running.clear()
+        self._thread.join()
+        for fd in (self._esp32_master, self._esp32_slave, self._nano_master, self._nano_slave):
+            os.close(fd)
+
+    def env(self):
+        return {"ESP32_PORT": self.esp32_port, "ARDUINO_PORT": self.nano_port}
+
+    def _run(self):
+        boards = {self._esp32_master: self.esp32, self._nano_master: self.nano}
+        masters = {board: fd for fd, board in boards.items()}
+        next_frame = time.monotonic()
+        while self._running.is_set():
+            now = time.monotonic()
+            wait = next_frame - now
+            if self._pending:
+                wait = min(wait, self._pending[0][0] - now)
+            readable, _, _ = select.select(list(boards), [], [], max(wait, 0.0))
+            now = time.monotonic()
+            for fd in readable:
+                try:
+                    self._buffers[fd] += os.read(fd, 1024)
+                except (BlockingIOError, OSError):
+                    continue
+                *lines, self._buffers[fd] = self._buffers[fd].split(b"\n")
+                for line in lines:
+                    line = line.decode("utf-8", errors="ignore").strip()
+                    if line:
+                        self._pending.append((now + self.esp32.latency, boards[fd], line))
+                self._pending.sort(key=lambda item: item[0])
+            while self._pending and self._pending[0][0] <= now:
+                due, board, line = self._pending.pop(0)
+                reply = board.handle(line, due)
+                if reply:
+                    try:
+                        os.write(masters[board], (reply + "\n").encode())
+                    except BlockingIOError:
+                        pass
+            if now >= next_frame:
+                try:
+                    os.write(self._esp32_master, self.esp32.frame(now))
+                except BlockingIOError:
+                    pass
+                next_frame = now + self.esp32.telemetry_interval
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the ESP32 and Nano boards on pseudo-terminals")
+    parser.add_argument("--speed-x", type=float, default=250.0, help="X axis speed per second")
+    parser.add_argument("--speed-y", type=float, default=250.0, help="Y axis speed per second")
+    parser.add_argument("--speed-z", type=float, default=0.15, help="Lift speed per second")
+    parser.add_argument("--telemetry-hz", type=float, default=10.0, help="AK80 frames per second")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before a command takes effect")
+    parser.add_argument("--chassis-time", type=float, default=1.5, help="Seconds to switch chassis mode")
+    parser.add_argument("--no-acks", action="store_true", help="Behave like firmware without command acknowledgements")
+    parser.add_argument("--no-binary", action="store_true", help="Behave like firmware with AK80 text telemetry only")
+    args = parser.parse_args()
+
+    boards = SimulatedBoards(
+        {"x": args.speed_x, "y": args.speed_y, "z": args.speed_z},
+        args.telemetry_hz, args.latency, args.chassis_time, not args.no_acks, not args.no_binary,
+    ).start()
+    print(" ".join(f"{key}={value}" for key, value in boards.env().items()))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\nStopping simulator...")
+        boards.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Several robots on one rack, served by one process.
+
+fleet.json (or the file in FLEET_FILE) lists the robots, each with its own
+boards and, optionally, route parameters of its own such as its home:
+
+    {"robots": [
+      {"robot_id": "1", "esp32": "/dev/ttyUSB0", "nano": "/dev/ttyUSB1",
+       "params": {"home_x": 3197, "home_y": 0}},
+      {"robot_id": "2", "esp32": "/dev/ttyUSB2", "nano": "/dev/ttyUSB3",
+       "params": {"home_x": 3197, "home_y": 824}}
+    ]}
+
+Without the file the fleet is the one robot on ESP32_PORT / ARDUINO_PORT, as
+before. Every track of the rack is an aisle (named in rack.json) and every
+junction is one too. Missions claim the aisles their route drives through in
+CellReservations, so two robots never drive the same aisle at once, and a
+robot keeps the aisle it stands in. In a fleet each robot therefore drives
+back to its home after every job, and homes belong away from the port and
+the aisles most routes share. The Dispatcher hands a job to a robot whose
+route is free: above, A1 jobs go to robot 2, which waits in A1's aisle.
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from mission import DEFAULT_ROBOT_ID
+from serial_transport import ARDUINO_PORT, ESP32_PORT
+
+FLEET_FILE = os.environ.get('FLEET_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), "fleet.json"))
+# Seconds a mission waits for its aisles before its job fails
+RESERVATION_TIMEOUT = 600.0
+
+
+def load_fleet(path=FLEET_FILE):
+    try:
+        with open(path) as f:
+            robots = json.load(f)["robots"]
+    except FileNotFoundError:
+        return [{"robot_id": DEFAULT_ROBOT_ID, "esp32": ESP32_PORT, "nano": ARDUINO_PORT}]
+    ids = [robot["robot_id"] for robot in robots]
+    if not ids or len(set(ids)) != len(ids):
+        raise ValueError(f"{path} must list robots with distinct robot_id values")
+    return robots
+
+
+class CellReservations:
+    """Which robot holds which aisle.
+
+    A robot claims every aisle its route drives through in one go and waits
+    while another robot holds any of them. When the route ends it keeps the
+    aisles it is left standing in (`standing`) until a later claim moves it
+    out; after a failed route it keeps them all, since it stopped somewhere
+    along the way. Claims are all-or-nothing, so a waiting robot holds
+    nothing but the spot it stands on. Two robots each standing in the
+    other's way still wait for each other, hence the timeout.
+    """
+
+    def __init__(self):
+        self._holders = {}
+        self._changed = threading.Condition()
+
+    @contextmanager
+    def hold(self, robot_id, aisles, standing=(), timeout=None):
+        aisles = set(aisles)
+        with self._changed:
+            free = self._changed.wait_for(
+                lambda: all(self._holders.get(name, robot_id) == robot_id for name in aisles), timeout,
+            )
+            if not free:
+                raise TimeoutError(f"Robot {robot_id} could not reserve aisles {sorted(aisles)}")
+            for name in aisles:
+                self._holders[name] = robot_id
+        try:
+            yield
+        except BaseException:
+            standing = None
+            raise
+        finally:
+            if standing is not None:
+                self._release(robot_id, set(standing))
+
+    def available(self, robot_id, aisles):
+        # Whether a claim on `aisles` would go through without waiting
+        with self._changed:
+            return all(self._holders.get(name, robot_id) == robot_id for name in aisles)
+
+    def stand(self, robot_id, aisles, timeout=None):
+        # Hold just the aisles a robot stands in, e.g. at home after homing
+        with self.hold(robot_id, aisles, aisles, timeout):
+            pass
+
+    def _release(self, robot_id, keep):
+        with self._changed:
+            for name, holder in list(self._holders.items()):
+                if holder == robot_id and name not in keep:
+                    del self._holders[name]
+            self._changed.notify_all()
+
+    def snapshot(self):
+        with self._changed:
+            return dict(self._holders)
+
+
+class Dispatcher:
+    """Picks the robot for a job: the one that can start on it soonest.
+
+    That is the work already queued on each robot plus its travel from
+    where it is now to where the job first needs it. With one robot this is
+    always that robot.
+    """
+
+    def __init__(self, controllers):
+        self.controllers = controllers
+
+    def choose(self, kind, cell_id=None):
+        if len(self.controllers) == 1:
+            return next(iter(self.controllers.values()))
+        # A robot whose route another robot stands in would only wait for it
+        free = [controller for controller in self.controllers.values() if controller.can_start(kind, cell_id)]
+        return min(
+            free or self.controllers.values(),
+            key=lambda controller: controller.jobs.backlog() + controller.travel_time(kind, cell_id),
+        )
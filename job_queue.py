@@ -0,0 +1,171 @@
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+QUEUED = "QUEUED"
+RUNNING = "RUNNING"
+DONE = "DONE"
+FAILED = "FAILED"
+
+# Finished jobs kept around so clients can still poll their status
+JOB_HISTORY_LIMIT = 200
+
+
+class Job:
+    def __init__(self, job_id, kind, order_id, params=None, size=None):
+        self.job_id = job_id
+        self.kind = kind
+        self.order_id = order_id
+        self.params = params or {}
+        # Units of work the ETA scales with, e.g. the trips of a batch; by default
+        # one per order
+        if size is None:
+            size = len(order_id) if isinstance(order_id, (list, tuple)) else 1
+        self.size = size
+        self.status = QUEUED
+        self.error = None
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "order_id": self.order_id,
+            "params": self.params,
+            "status": self.status,
+            "error": self.error,
+            "enqueued_at": self.enqueued_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """Runs submitted jobs one at a time on a single executor thread.
+
+    `handlers` maps a job kind ("delivery", "return") to a callable taking the
+    order id and the job's params as keyword arguments. Only the executor thread calls handlers, so it is the only thread
+    that talks to the serial ports. `on_idle`, if given, is called on that
+    thread once the queue has stayed empty for `idle_delay` seconds after a job.
+    """
+
+    def __init__(self, handlers, estimated_durations, on_idle=None, idle_delay=None, robot_id=None):
+        self.handlers = handlers
+        self.robot_id = robot_id
+        self.estimated_durations = dict(estimated_durations)
+        self.on_idle = on_idle
+        self.idle_delay = idle_delay
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()
+        self._pending = []
+        self._running = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="job-executor", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def submit(self, kind, order_id, params=None, size=None):
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        with self._lock:
+            job = Job(uuid.uuid4().hex, kind, order_id, params, size)
+            self._jobs[job.job_id] = job
+            self._pending.append(job)
+            self._trim_history()
+        self._queue.put(job)
+        print(f"Queued {kind} job {job.job_id} for order {order_id}")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self):
+        with self._lock:
+            return len(self._pending) + (1 if self._running else 0)
+
+    def backlog(self):
+        # Seconds until everything queued so far is expected to be done
+        with self._lock:
+            return max(self._etas().values(), default=0.0)
+
+    def describe(self, job):
+        with self._lock:
+            return self._describe(job, self._etas())
+
+    def snapshot(self):
+        with self._lock:
+            etas = self._etas()
+            return {
+                "depth": len(self._pending) + (1 if self._running else 0),
+                "running": self._describe(self._running, etas) if self._running else None,
+                "pending": [self._describe(job, etas) for job in self._pending],
+            }
+
+    def _describe(self, job, etas):
+        info = job.to_dict()
+        info["robot_id"] = self.robot_id
+        info["eta"] = etas.get(job.job_id)
+        return info
+
+    def _etas(self):
+        # Seconds from now until each unfinished job is expected to complete
+        now = time.time()
+        etas = {}
+        elapsed = 0.0
+        if self._running:
+            expected = self.estimated_durations[self._running.kind] * self._running.size
+            elapsed = max(expected - (now - self._running.started_at), 0.0)
+            etas[self._running.job_id] = round(elapsed, 1)
+        for job in self._pending:
+            elapsed += self.estimated_durations[job.kind] * job.size
+            etas[job.job_id] = round(elapsed, 1)
+        return etas
+
+    def _trim_history(self):
+        while len(self._jobs) > JOB_HISTORY_LIMIT:
+            oldest_id, oldest = next(iter(self._jobs.items()))
+            if oldest.status not in (DONE, FAILED):
+                break
+            del self._jobs[oldest_id]
+
+    def _run(self):
+        idle = True
+        while True:
+            try:
+                job = self._queue.get(timeout=None if idle or self.on_idle is None else self.idle_delay)
+            except queue.Empty:
+                idle = True
+                try:
+                    self.on_idle()
+                except Exception as e:
+                    print(f"Idle handler failed: {e}")
+                continue
+            idle = False
+            with self._lock:
+                self._pending.remove(job)
+                self._running = job
+                job.status = RUNNING
+                job.started_at = time.time()
+            print(f"Running {job.kind} job {job.job_id} for order {job.order_id}")
+            try:
+                self.handlers[job.kind](job.order_id, **job.params)
+                status, error = DONE, None
+            except Exception as e:
+                print(f"Job {job.job_id} failed: {e}")
+                status, error = FAILED, str(e)
+            with self._lock:
+                job.status = status
+                job.error = error
+                job.finished_at = time.time()
+                self._running = None
+                if status == DONE:
+                    # Keep the ETA model close to what the robot actually does
+                    took = (job.finished_at - job.started_at) / job.size
+                    self.estimated_durations[job.kind] = 0.8 * self.estimated_durations[job.kind] + 0.2 * took
+            self._queue.task_done()
@@ -0,0 +1,82 @@
+"""Push robot position and status to dashboards over Server-Sent Events.
+
+Every telemetry frame and status change bumps a version number and wakes the
+subscribers. Each subscriber sends at most one update per its own interval,
+carrying only the latest position and status. A slow client skips
+intermediate frames instead of queueing them.
+"""
+import json
+import threading
+import time
+
+DEFAULT_INTERVAL = 0.2
+MIN_INTERVAL = 0.05
+KEEPALIVE_INTERVAL = 15.0
+# Position changes smaller than this (per axis) are not worth an update
+POSITION_EPSILON = (0.5, 0.5, 0.005)
+
+
+class LiveState:
+    def __init__(self, telemetry):
+        self.telemetry = telemetry
+        self.status = None
+        self.version = 0
+        self._changed = threading.Condition()
+        telemetry.listeners.append(self._bump)
+
+    def set_status(self, status):
+        self.status = status
+        self._bump()
+
+    def _bump(self, snapshot=None):
+        with self._changed:
+            self.version += 1
+            self._changed.notify_all()
+
+    def wait(self, version, timeout):
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def subscribe(self, interval=DEFAULT_INTERVAL):
+        """SSE messages for one client, forever; close the generator to stop."""
+        interval = max(interval, MIN_INTERVAL)
+        version = -1
+        sent_position = None
+        sent_status = None
+        last_message = 0.0
+        while True:
+            version = self.wait(version, KEEPALIVE_INTERVAL)
+            messages = []
+            snapshot = self.telemetry.latest
+            if snapshot is not None and moved(sent_position, snapshot):
+                sent_position = snapshot
+                messages.append(event("position", {
+                    "x": snapshot.x, "y": snapshot.y, "z": snapshot.z,
+                    "stopped_by_sensor": snapshot.stopped_by_sensor,
+                }))
+            if self.status != sent_status:
+                sent_status = self.status
+                messages.append(event("status", {"status": sent_status}))
+            now = time.monotonic()
+            if messages:
+                yield "".join(messages)
+            elif now - last_message >= KEEPALIVE_INTERVAL:
+                yield ": keepalive\n\n"
+            else:
+                continue
+            last_message = now
+            # Throttle: whatever arrives meanwhile is coalesced into the next message
+            time.sleep(interval)
+
+
+def moved(previous, snapshot):
+    if previous is None:
+        return True
+    if previous.stopped_by_sensor != snapshot.stopped_by_sensor:
+        return True
+    return any(abs(a - b) > eps for a, b, eps in zip(previous[:3], snapshot[:3], POSITION_EPSILON))
+
+
+def event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
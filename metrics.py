@@ -0,0 +1,151 @@
+"""In-process metrics in the Prometheus text format, served at /metrics.
+
+Counters and histograms are updated from the hot loops (every telemetry
+frame, every serial write), so an update is one bisect and a couple of
+additions under a per-metric lock. Gauges that mirror existing state (queue
+depth, position) are read through a callback at scrape time instead.
+"""
+import threading
+from bisect import bisect_left
+
+# Seconds; wide enough for a serial write at the low end and a mission at the top
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.render(self.name, format_labels(self.labelnames, values), values, self.labelnames))
+        return lines
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name, labels, values, labelnames):
+        return [f"{name}{labels} {self.value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self, name, labels, values, labelnames):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(labelnames, values, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_sum{labels} {total}")
+        lines.append(f"{name}_count{labels} {cumulative}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Gauge(Metric):
+    """A value read at scrape time: `callback()` returns {label values tuple: value}."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        if self.callback is None:
+            return lines
+        for values, value in sorted(self.callback().items()):
+            if value is not None:
+                lines.append(f"{self.name}{format_labels(self.labelnames, values)} {value}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+MISSION_DURATION = Histogram("robot_mission_duration_seconds", "Duration of whole missions.", ["mission", "outcome"])
+STEP_DURATION = Histogram("robot_step_duration_seconds", "Duration of mission steps.", ["action"])
+SERIAL_WRITE = Histogram("robot_serial_write_seconds", "Time to write one line to a serial port.", ["port"])
+MONGO_WRITE = Histogram("robot_mongo_write_seconds", "Time of one MongoDB write.", ["collection"])
+TELEMETRY_INTERVAL = Histogram(
+    "robot_telemetry_interval_seconds", "Time between consecutive telemetry frames.",
+    buckets=(0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5),
+)
+TELEMETRY_FRAMES = Counter("robot_telemetry_frames_total", "Telemetry frames received.", ["format"])
+PARSE_ERRORS = Counter("robot_telemetry_parse_errors_total", "Telemetry lines or frames that failed to parse.", ["format"])
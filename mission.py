@@ -0,0 +1,458 @@
+import json
+import os
+import threading
+import time
+from functools import lru_cache
+
+from cell_registry import CellRegistry
+from metrics import STEP_DURATION
+from planner import ARRIVAL_TOLERANCE, DIRECTIONS, AxisModel, RackGrid, legs_to_steps
+
+ROUTES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "routes")
+RACK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rack.json")
+# Written by `python motion_analysis.py --write`; planning falls back to rack.json speeds without it
+MOTION_MODEL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "motion_model.json")
+
+# Used when a goto / wait_arrival step does not set its own timeout
+DEFAULT_MOVE_TIMEOUT = {"x": 20, "y": 15, "z": 30}
+CHASSIS_SETTLE_TIME = 2
+
+# Robot whose status a runner writes when none is given, as in a one-robot install
+DEFAULT_ROBOT_ID = "1"
+
+# Steps that touch the order documents rather than the robot
+ORDER_ACTIONS = ("order_status", "sku_status", "archive_order")
+
+ACTIONS = (
+    "order_status", "robot_status", "sku_status", "archive_order",
+    "chassis", "travel", "goto", "move", "wait_arrival", "gripper", "sleep", "parallel",
+)
+# Branches of a parallel step run from known positions, so no planning inside them
+BRANCH_ACTIONS = tuple(action for action in ACTIONS if action not in ("travel", "move", "parallel"))
+
+# Safety interlocks: the actuator pairs whose steps may run at the same time in
+# different branches of a parallel step. Anything not listed stays sequential:
+# the drive never moves with the lift or while the chassis switches, the chassis
+# only switches with the lift at travel height (routes go to stable before
+# lowering and raise the lift before leaving it), and the gripper never moves
+# while the robot drives (a release would drop the box).
+SAFE_OVERLAPS = {
+    frozenset({"lift", "gripper"}),
+    frozenset({"chassis", "gripper"}),
+    frozenset({"db", "lift"}),
+    frozenset({"db", "drive"}),
+    frozenset({"db", "gripper"}),
+    frozenset({"db", "chassis"}),
+    frozenset({"db"}),
+}
+
+
+class RouteError(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def load_route(name):
+    path = os.path.join(ROUTES_DIR, f"{name}.json")
+    try:
+        with open(path) as f:
+            route = json.load(f)
+    except FileNotFoundError:
+        raise RouteError(f"Unknown route: {name}")
+    for step in route["steps"]:
+        if step.get("action") not in ACTIONS:
+            raise RouteError(f"Route {name} has an unknown action: {step}")
+        for branch in step.get("branches", ()) if step["action"] == "parallel" else ():
+            for inner in branch:
+                if inner.get("action") not in BRANCH_ACTIONS:
+                    raise RouteError(f"Route {name} has an action not allowed in a parallel step: {inner}")
+    return route
+
+
+@lru_cache(maxsize=None)
+def load_rack(path=RACK_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=None)
+def load_motion_model(path=MOTION_MODEL_FILE):
+    try:
+        with open(path) as f:
+            axes = json.load(f)["axes"]
+    except FileNotFoundError:
+        return {}
+    return {axis: AxisModel(fit["overhead"], fit["seconds_per_unit"], fit["residual"]) for axis, fit in axes.items()}
+
+
+@lru_cache(maxsize=None)
+def cell_registry():
+    # Loaded once; routes compiled for a cell are dropped when that cell changes
+    registry = CellRegistry(load_rack())
+    registry.listeners.append(lambda cell_id: compiled_route.cache_clear())
+    return registry
+
+
+def cell_params(cell_id, registry=None):
+    # Route placeholders: rack-wide values as-is, cell values prefixed with "cell_"
+    registry = registry or cell_registry()
+    cell = registry.get(cell_id)
+    if cell is None:
+        raise RouteError(f"Unknown cell: {cell_id}")
+    params = dict(registry.params)
+    params.update({f"cell_{key}": value for key, value in cell.items()})
+    return params
+
+
+def resolve(value, params):
+    if isinstance(value, str) and value.startswith("$"):
+        try:
+            return params[value[1:]]
+        except KeyError:
+            raise RouteError(f"Route references unknown parameter {value}")
+    return value
+
+
+def applies(step, params):
+    # "if" / "unless" name a route parameter: the step is only for cells that
+    # have it (or lack it), e.g. the dig-out steps of a cell with a buffer
+    if "if" in step and step["if"] not in params:
+        return False
+    return not ("unless" in step and step["unless"] in params)
+
+
+def resolve_step(raw, params):
+    return {key: resolve(value, params) for key, value in raw.items() if key not in ("if", "unless")}
+
+
+def actuator(step):
+    # What a step drives, for the interlock check; None for steps that only wait
+    action = step["action"]
+    if action == "goto":
+        return "lift" if step["axis"] == "z" else "drive"
+    if action in ("chassis", "gripper"):
+        return action
+    if action in ("order_status", "robot_status", "sku_status", "archive_order"):
+        return "db"
+    return None
+
+
+def check_interlocks(branches, route_name):
+    used = [{actuator(step) for step in branch} - {None} for branch in branches]
+    for i, first in enumerate(used):
+        for second in used[i + 1:]:
+            for a in first:
+                for b in second:
+                    if frozenset({a, b}) not in SAFE_OVERLAPS:
+                        raise RouteError(f"Route {route_name} runs {a} and {b} in parallel, which is not declared safe")
+
+
+def compile_route(route, params, grid=None, start=None, chassis=None):
+    """Resolve placeholders, plan travel steps and drop steps that cannot change anything.
+
+    A travel step is expanded into the planner's chassis/goto legs, starting
+    from `start` (the robot's X/Y, optionally Z, when the route begins) or from
+    wherever an earlier step left it, with the chassis in mode `chassis`. With a motion model on the grid, goto
+    timeouts are tightened to the fitted move time. A goto is dropped when an earlier step of the same
+    route already commanded that position, and a chassis change is dropped when
+    the chassis is already in that mode or no move follows before the next change.
+    Parallel steps are checked against SAFE_OVERLAPS and kept as they are.
+    Steps whose "if" / "unless" parameter is missing / present are left out.
+    """
+    steps = []
+    position = dict(zip("xyz", start)) if start else {}
+    commanded = {}
+    pending = [resolve_step(raw, params) for raw in route["steps"] if applies(raw, params)]
+    pending.reverse()
+    while pending:
+        step = pending.pop()
+        action = step["action"]
+        if action == "travel":
+            if grid is None or "x" not in position or "y" not in position:
+                raise RouteError(f"Route {route['name']} travels without a rack grid or start position")
+            legs, _ = grid.plan((position["x"], position["y"]), (step["x"], step["y"]), chassis)
+            pending.extend(reversed(legs_to_steps(legs, chassis, grid.leg_timeout)))
+            continue
+        if action == "move":
+            axis, sign = DIRECTIONS[step.pop("direction")]
+            if axis not in position:
+                # Relative moves need the position from an earlier step
+                raise RouteError(f"Route {route['name']} moves {axis} relatively before setting it")
+            step = dict(step, action="goto", axis=axis, position=position[axis] + sign * step.pop("distance"))
+            action = "goto"
+        if action == "goto":
+            step = fitted_timeout(step, position, grid)
+            position[step["axis"]] = step["position"]
+            if commanded.get(step["axis"]) == step["position"]:
+                continue
+            commanded[step["axis"]] = step["position"]
+        if action == "parallel":
+            branches = []
+            for raw_branch in step["branches"]:
+                branch = []
+                for raw in raw_branch:
+                    if not applies(raw, params):
+                        continue
+                    inner = resolve_step(raw, params)
+                    if inner["action"] == "goto":
+                        inner = fitted_timeout(inner, position, grid)
+                        position[inner["axis"]] = commanded[inner["axis"]] = inner["position"]
+                    elif inner["action"] == "chassis":
+                        chassis = inner["mode"]
+                    branch.append(inner)
+                branches.append(tuple(branch))
+            check_interlocks(branches, route["name"])
+            step = dict(step, branches=tuple(branches))
+        if action == "chassis":
+            if steps and steps[-1]["action"] == "chassis":
+                steps.pop()
+                chassis = last_chassis_mode(steps)
+            if step["mode"] == chassis:
+                continue
+            chassis = step["mode"]
+        steps.append(step)
+    return tuple(steps)
+
+
+def fitted_timeout(step, position, grid):
+    # The route's timeout stays the upper bound; the fitted one only tightens it
+    axis = step["axis"]
+    if grid is None or axis not in position or not step.get("wait", True):
+        return step
+    fitted = grid.move_timeout(axis, position[axis], step["position"])
+    if fitted is None:
+        return step
+    return dict(step, timeout=min(step.get("timeout", DEFAULT_MOVE_TIMEOUT[axis]), fitted))
+
+
+def last_chassis_mode(steps):
+    for step in reversed(steps):
+        if step["action"] == "chassis":
+            return step["mode"]
+    return None
+
+
+@lru_cache(maxsize=None)
+def rack_grid():
+    return RackGrid.from_layout(load_rack(), load_motion_model())
+
+
+def home_position(overrides=()):
+    # `overrides` are (name, value) pairs replacing rack-wide route parameters
+    # for one robot, e.g. its own home in a fleet
+    params = dict(cell_registry().params, **dict(overrides))
+    return (params["home_x"], params["home_y"], params["travel_z"])
+
+
+def port_position():
+    # Where deliveries drop the box and returns pick it up; home is only where a robot waits
+    params = cell_registry().params
+    return (params["port_x"], params["port_y"], params["travel_z"])
+
+
+def route_start(position, overrides=()):
+    """Where a route should start for a robot measured at `position`.
+
+    Every route ends with the lift at travel height and the chassis stable,
+    so the next one can start wherever the last one left the robot, snapped
+    onto the junction, track end or track it stands on. A robot off the tracks or with its lift
+    lowered (after an abort) raises RouteError: planning from home would
+    drive it with the box still in a cell, so it has to be re-homed first.
+    """
+    x, y, z = position
+    travel_z = home_position(overrides)[2]
+    point = rack_grid().snap((x, y))
+    if abs(z - travel_z) > ARRIVAL_TOLERANCE[2]:
+        raise RouteError(f"Lift at {z}, not at travel height {travel_z}; re-home the robot")
+    if point is None:
+        raise RouteError(f"Robot at ({x}, {y}) is off the tracks; re-home the robot")
+    return point + (travel_z,)
+
+
+def route_end(steps, start):
+    # The X/Y a route leaves the robot at
+    point = tuple(start[:2])
+    for step in steps:
+        for inner in [step] + [inner for branch in step.get("branches", ()) for inner in branch]:
+            if inner["action"] == "goto" and inner["axis"] != "z":
+                point = (inner["position"], point[1]) if inner["axis"] == "x" else (point[0], inner["position"])
+    return point
+
+
+def route_aisles(steps, start):
+    """The aisles a route drives through from `start`, and the ones it leaves
+    the robot standing in."""
+    grid = rack_grid()
+    point = tuple(start[:2])
+    aisles = grid.aisles_at(point)
+    for step in steps:
+        for inner in [step] + [inner for branch in step.get("branches", ()) for inner in branch]:
+            if inner["action"] != "goto" or inner["axis"] == "z":
+                continue
+            target = (inner["position"], point[1]) if inner["axis"] == "x" else (point[0], inner["position"])
+            aisles |= grid.aisles_between(point, target)
+            point = target
+    return aisles, grid.aisles_at(point)
+
+
+@lru_cache(maxsize=256)
+def compiled_route(name, cell_id, start=None, overrides=()):
+    # Routes are precompiled once per (route, cell, start) and reused for every
+    # order. Without a start the robot is at home, lift at travel height.
+    params = dict(cell_params(cell_id), **dict(overrides))
+    return compile_route(load_route(name), params, rack_grid(), start or home_position(overrides), "stable")
+
+
+def estimated_cycle_time(name, cell_id):
+    # Seconds the route should take, from the motion model where there is one
+    total, _ = simulate(compiled_route(name, cell_id), load_rack()["speeds"], load_motion_model())
+    return total
+
+
+def without_actions(steps, actions):
+    kept = []
+    for step in steps:
+        if step["action"] in actions:
+            continue
+        if step["action"] == "parallel":
+            step = dict(step, branches=tuple(without_actions(branch, actions) for branch in step["branches"]))
+        kept.append(step)
+    return tuple(kept)
+
+
+class MissionRunner:
+    """Executes compiled route steps against a robot and the status database.
+
+    `robot` provides change_chassis(mode), move_to(axis, position),
+    send_nano_command(command), wait_for_arrival(timeout) and sleep(seconds).
+    `db` may be None, in which case status steps are skipped.
+    `on_robot_status`, if given, is called with every robot status the route sets;
+    statuses are stored under `robot_id`.
+    The branches of a parallel step run on their own threads; the step ends
+    when the slowest branch does, and the first branch error is re-raised.
+    """
+
+    record_metrics = True
+
+    def __init__(self, robot, db=None, clock=time.monotonic, on_robot_status=None, robot_id=DEFAULT_ROBOT_ID):
+        self.robot = robot
+        self.db = db
+        self.robot_id = robot_id
+        self.clock = clock
+        self.on_robot_status = on_robot_status
+
+    def run(self, steps, order_id=None):
+        timings = []
+        for step in steps:
+            started = self.clock()
+            self.execute(step, order_id)
+            duration = self.clock() - started
+            if self.record_metrics:
+                STEP_DURATION.labels(step["action"]).observe(duration)
+            timings.append((step, duration))
+        return timings
+
+    def run_branches(self, branches, order_id):
+        errors = []
+
+        def run_branch(branch):
+            try:
+                self.run(branch, order_id)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run_branch, args=(branch,), daemon=True) for branch in branches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def execute(self, step, order_id):
+        action = step["action"]
+        if action == "parallel":
+            self.run_branches(step["branches"], order_id)
+        elif action == "chassis":
+            self.robot.change_chassis(step["mode"])
+        elif action == "goto":
+            self.robot.move_to(step["axis"], step["position"])
+            if step.get("wait", True):
+                self.robot.wait_for_arrival(step.get("timeout", DEFAULT_MOVE_TIMEOUT[step["axis"]]))
+        elif action == "wait_arrival":
+            self.robot.wait_for_arrival(step.get("timeout", max(DEFAULT_MOVE_TIMEOUT.values())))
+        elif action == "gripper":
+            self.robot.send_nano_command(step["command"])
+            if step.get("duration"):
+                self.robot.sleep(step["duration"])
+        elif action == "sleep":
+            self.robot.sleep(step["seconds"])
+        else:
+            if action == "robot_status" and self.on_robot_status:
+                self.on_robot_status(step["status"])
+            if self.db is None:
+                return
+            if action == "order_status":
+                self.db.update_order_status_by_id(order_id, step["status"])
+            elif action == "robot_status":
+                self.db.update_robot_status(step["status"], self.robot_id)
+            elif action == "sku_status":
+                self.db.set_sku_in_order_status_by_id(order_id, step["status"])
+            elif action == "archive_order":
+                self.db.archivate_order(order_id)
+
+
+class SimulatedRobot:
+    """Stand-in robot on a virtual clock, for timing a route without hardware."""
+
+    def __init__(self, axis_speeds, chassis_time=CHASSIS_SETTLE_TIME, motion_model=None):
+        self.axis_speeds = axis_speeds
+        self.chassis_time = chassis_time
+        self.motion_model = motion_model or {}
+        self.now = 0.0
+        self.position = {"x": 0.0, "y": 0.0, "z": 0.0}
+        self.arrival = 0.0
+
+    def clock(self):
+        return self.now
+
+    def change_chassis(self, mode):
+        self.now += self.chassis_time
+
+    def move_to(self, axis, position):
+        distance = position - self.position[axis]
+        if axis in self.motion_model:
+            self.arrival = self.now + self.motion_model[axis].time(distance)
+        else:
+            self.arrival = self.now + abs(distance) / self.axis_speeds[axis]
+        self.position[axis] = position
+
+    def wait_for_arrival(self, timeout):
+        self.now = max(self.now, self.arrival)
+
+    def send_nano_command(self, command):
+        pass
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class SimulatedMissionRunner(MissionRunner):
+    # The virtual clock cannot be shared between threads: run each branch from
+    # the same start time and continue from the one that ends last
+    record_metrics = False
+
+    def run_branches(self, branches, order_id):
+        started = self.robot.now
+        finished = started
+        for branch in branches:
+            self.robot.now = started
+            self.run(branch, order_id)
+            finished = max(finished, self.robot.now)
+        self.robot.now = finished
+
+
+def simulate(steps, axis_speeds, motion_model=None):
+    robot = SimulatedRobot(axis_speeds, motion_model=motion_model)
+    timings = SimulatedMissionRunner(robot, clock=robot.clock).run(steps)
+    return robot.now, timings
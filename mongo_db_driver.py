@@ -1,14 +1,61 @@
 import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
 from urllib.parse import quote_plus
 
 import pymongo as pm
 
-MONGO_HOST = "192.168.8.95:27017/?directConnection=true"
-MONGO_PASS = "chlen"
-MONGO_USER = "mnogo"
+from metrics import MONGO_WRITE
+from outbox import Outbox
+
+MONGO_HOST = os.environ.get('MONGO_HOST', "192.168.8.95:27017/?directConnection=true")
+# Credentials have no default: they must come from the environment
+MONGO_PASS = os.environ.get('MONGO_PASS')
+MONGO_USER = os.environ.get('MONGO_USER')
+
+# Fail fast instead of pymongo's 30 s server selection: a status write must
+# never stall a move. A write that cannot reach the server goes to the outbox.
+MONGO_CLIENT_OPTIONS = {
+    'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 10)),
+    'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', 1)),
+    'maxIdleTimeMS': int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 60000)),
+    'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 2000)),
+    'connectTimeoutMS': int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 2000)),
+    'socketTimeoutMS': int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 5000)),
+    'waitQueueTimeoutMS': int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 2000)),
+    'retryWrites': True,
+}
+# Local SQLite file holding writes made while Mongo was unreachable
+MONGO_OUTBOX = os.environ.get(
+    'MONGO_OUTBOX', os.path.join(os.path.dirname(os.path.abspath(__file__)), "mongo_outbox.sqlite3"),
+)
+OUTBOX_RETRY_INTERVAL = 2.0
+# Longest an archive waits for queued status updates to reach the server
+ARCHIVE_FLUSH_TIMEOUT = 5.0
+
+# Write-behind mode: how long updates are coalesced before a flush, and how many
+# failed flushes a single document's update survives before it is dropped
+WRITE_BEHIND_INTERVAL = 0.2
+WRITE_BEHIND_RETRIES = 5
+WRITE_BEHIND_BACKOFF = 1.0
+# Pause before reopening a cells change stream after a network error
+WATCH_RETRY_INTERVAL = 5.0
+
+# Orders waiting for the robot, oldest first by the time the shop created them.
+# Order documents are keyed by the order ID string the shop assigns (never an
+# ObjectId), and every method here takes and returns those strings.
+PENDING_ORDER_STATUSES = ('NEW',)
+ORDER_CREATED_FIELD = 'created_at'
+# What a scheduler needs from an order: where its items are, not the whole document
+ORDER_LOCATION_FIELDS = {'status': 1, 'item_list.cell': 1, 'item_list.sku': 1}
 
 class DbController:
     _instance = None
+    # Swapped for a stand-in such as mongomock.MongoClient by the benchmarks
+    client_factory = pm.MongoClient
+    outbox_path = MONGO_OUTBOX
 
     def __new__(cls):
         if cls._instance is None:
@@ -17,33 +64,324 @@ class DbController:
         return cls._instance
 
     def __initialize_client(self):
+        # Local state only, so building the controller never fails; the client
+        # is created by connect(), whose errors the caller's startup reports
+        self.__client = None
+        self.__ecom = None
+        self.__transactions = None
+        self.__writer = None
+        self.__pending = {}
+        self.__attempts = {}
+        self.__in_flight = 0
+        self.__changed = threading.Condition()
+        self.__outbox = Outbox(self.outbox_path)
+        self.__draining = False
+
+    def connect(self):
+        """Create the Mongo client, once; raises RuntimeError without credentials."""
+        if self.__client is not None:
+            return
+        missing = [name for name, value in (('MONGO_USER', MONGO_USER), ('MONGO_PASS', MONGO_PASS)) if not value]
+        if missing:
+            raise RuntimeError(f"Set {' and '.join(missing)} in the environment to connect to Mongo")
         try:
             uri = "mongodb://%s:%s@%s" % (quote_plus(MONGO_USER), quote_plus(MONGO_PASS), MONGO_HOST)
-            _mongo_client = pm.MongoClient(uri)
+            _mongo_client = self.client_factory(uri, **MONGO_CLIENT_OPTIONS)
             # _mongo_client = pm.MongoClient(MONGO_HOST, MONGO_PORT)
         except:
             logging.error('Mongo DB connection failed: %s', MONGO_HOST)
             raise Exception('Mongo DB connection failed')
 
         self.__ecom = _mongo_client.ecom
+        self.__client = _mongo_client
+        if len(self.__outbox):
+            # Writes left over from an outage before the last restart
+            with self.__changed:
+                self.__start_draining()
+
+    def start_write_behind(self, interval=WRITE_BEHIND_INTERVAL, max_retries=WRITE_BEHIND_RETRIES):
+        """Queue status updates in memory and flush them from a background thread.
+
+        Updates to the same document are coalesced so only the latest fields are
+        written, and each flush sends one bulk_write per collection. Callers never
+        wait on the network; failed flushes are retried up to `max_retries` times.
+        """
+        if self.__writer is not None:
+            return
+        self.__interval = interval
+        self.__max_retries = max_retries
+        self.__writer = threading.Thread(target=self.__write_loop, name="mongo-write-behind", daemon=True)
+        self.__writer.start()
+
+    def flush(self, timeout=None):
+        # Wait until every queued update has been written, dropped or moved to the outbox
+        with self.__changed:
+            return self.__changed.wait_for(lambda: not self.__pending and not self.__in_flight, timeout)
 
+    def outbox_depth(self):
+        return len(self.__outbox)
+
+    def __set(self, collection, key, value, fields):
+        with self.__changed:
+            if self.__draining:
+                # Queue behind the outbox so writes to a document stay in order
+                self.__outbox.append('set', collection, key, value, fields)
+                return
+            if self.__writer is not None:
+                self.__pending.setdefault((collection, key, value), {}).update(fields)
+                self.__changed.notify_all()
+                return
+        try:
+            with self.__timed(collection):
+                self.__ecom[collection].update_one({key: value}, {"$set": fields})
+        except pm.errors.ConnectionFailure as e:
+            logging.warning('Mongo unreachable, writing to the outbox: %s', e)
+            with self.__changed:
+                self.__outbox.append('set', collection, key, value, fields)
+                self.__start_draining()
+
+    def __start_draining(self):
+        # Caller holds self.__changed
+        if self.__draining:
+            return
+        self.__draining = True
+        threading.Thread(target=self.__drain_outbox, name="mongo-outbox", daemon=True).start()
+
+    def __drain_outbox(self):
+        # Replays the outbox in order; normal writes resume once it is empty
+        while True:
+            rows = self.__outbox.peek()
+            if not rows:
+                with self.__changed:
+                    if not len(self.__outbox):
+                        self.__draining = False
+                        self.__changed.notify_all()
+                        logging.info('Mongo outbox replayed')
+                        return
+                continue
+            for row_id, op, collection, key, value, fields in rows:
+                while True:
+                    try:
+                        if op == 'archive':
+                            self.__archive(value)
+                        else:
+                            with self.__timed(collection):
+                                self.__ecom[collection].update_one({key: value}, {"$set": fields})
+                        break
+                    except pm.errors.ConnectionFailure:
+                        time.sleep(OUTBOX_RETRY_INTERVAL)
+                    except Exception as e:
+                        # Rejected by the server (or unreadable); retrying cannot help
+                        logging.error('Dropping outbox %s on %s %s=%s: %s', op, collection, key, value, e)
+                        break
+                self.__outbox.remove(row_id)
+
+    def __write_loop(self):
+        while True:
+            with self.__changed:
+                self.__changed.wait_for(lambda: self.__pending)
+            # Let updates that arrive close together collapse into one write
+            time.sleep(self.__interval)
+            try:
+                failed = self.__flush_pending()
+            except Exception as e:
+                # Never let the writer thread die: flush() would wait on it forever
+                logging.exception('Write-behind flush failed: %s', e)
+                failed = True
+            finally:
+                with self.__changed:
+                    self.__in_flight = 0
+                    self.__changed.notify_all()
+            if failed:
+                time.sleep(WRITE_BEHIND_BACKOFF)
+
+    def __flush_pending(self):
+        with self.__changed:
+            batch, self.__pending = self.__pending, {}
+            self.__in_flight = len(batch)
+        failed, unreachable = self.__write_batch(batch)
+        with self.__changed:
+            if unreachable:
+                # Anything still pending was queued after this batch
+                for (collection, key, value), fields in list(unreachable.items()) + list(self.__pending.items()):
+                    self.__outbox.append('set', collection, key, value, fields)
+                    self.__attempts.pop((collection, key, value), None)
+                self.__pending = {}
+                self.__start_draining()
+            for target, fields in failed.items():
+                attempts = self.__attempts.get(target, 0) + 1
+                if attempts > self.__max_retries:
+                    logging.error('Dropping update %s for %s after %d attempts', fields, target, attempts)
+                    self.__attempts.pop(target, None)
+                    continue
+                self.__attempts[target] = attempts
+                # Anything queued while the flush was failing is newer and wins
+                fields.update(self.__pending.get(target, {}))
+                self.__pending[target] = fields
+            for target in batch:
+                if target not in failed:
+                    self.__attempts.pop(target, None)
+        return bool(failed)
+
+    def __write_batch(self, batch):
+        by_collection = {}
+        for (collection, key, value), fields in batch.items():
+            by_collection.setdefault(collection, []).append(((collection, key, value), fields))
+        failed = {}
+        unreachable = {}
+        for collection, updates in by_collection.items():
+            try:
+                with self.__timed(collection):
+                    self.__ecom[collection].bulk_write(
+                        [pm.UpdateOne({key: value}, {"$set": fields}) for (_, key, value), fields in updates],
+                        ordered=False,
+                    )
+            except pm.errors.ConnectionFailure as e:
+                logging.warning('Mongo unreachable, moving %d updates to the outbox: %s', len(updates), e)
+                unreachable.update(updates)
+            except Exception as e:
+                # Never let the writer thread die; the batch is retried instead
+                logging.warning('Write-behind flush to %s failed: %s', collection, e)
+                failed.update(updates)
+        return failed, unreachable
 
     def update_order_status_by_id(self, order_id, status):
         the_order = {'status': status}
-        self.__ecom.orders.update_one({'_id': order_id}, {"$set": the_order})
+        self.__set('orders', '_id', order_id, the_order)
+
+    def update_orders_status_by_ids(self, order_ids, status):
+        if self.__writer is not None:
+            for order_id in order_ids:
+                self.update_order_status_by_id(order_id, status)
+            return
+        with self.__changed:
+            draining = self.__draining
+        if draining:
+            for order_id in order_ids:
+                self.update_order_status_by_id(order_id, status)
+            return
+        try:
+            with self.__timed('orders'):
+                self.__ecom.orders.update_many({'_id': {'$in': list(order_ids)}}, {"$set": {'status': status}})
+        except pm.errors.ConnectionFailure as e:
+            logging.warning('Mongo unreachable, writing to the outbox: %s', e)
+            with self.__changed:
+                for order_id in order_ids:
+                    self.__outbox.append('set', 'orders', '_id', order_id, {'status': status})
+                self.__start_draining()
+
+    def get_orders_by_ids(self, order_ids):
+        # One round-trip for a whole batch; only the item locations are needed
+        cursor = self.__ecom.orders.find({'_id': {'$in': list(order_ids)}}, ORDER_LOCATION_FIELDS)
+        return {order['_id']: order for order in cursor}
+
+    def get_pending_orders(self, limit=0):
+        """Orders waiting for the robot, oldest first, with only their item locations.
+
+        Sorted on the creation time, since string order IDs say nothing about
+        age. Served from the (status, created_at) index: no collection scan and
+        no in-memory sort.
+        """
+        cursor = self.__ecom.orders.find({'status': {'$in': list(PENDING_ORDER_STATUSES)}}, ORDER_LOCATION_FIELDS)
+        return list(cursor.sort(ORDER_CREATED_FIELD, pm.ASCENDING).limit(limit))
 
     def set_sku_in_order_status_by_id(self, order_id, status):
-        order = self.__ecom.orders.find_one({'_id': order_id})
-        for item in order['item_list']:
-            item['status'] = status
-        self.__ecom.orders.update_one({'_id': order_id}, {"$set": order})
+        # Every item in one server-side update, no read-modify-write
+        self.__set('orders', '_id', order_id, {'item_list.$[].status': status})
 
-    def update_robot_status(self, status):
+    def update_robot_status(self, status, robot_id="1"):
         the_robot = {'status': status}
-        self.__ecom.robots.update_one({'robot_id': "1"}, {"$set": the_robot})
+        self.__set('robots', 'robot_id', robot_id, the_robot)
+
+    def load_cells(self, registry):
+        # Documents in `cells` are keyed by cell ID and override rack.json entries
+        for cell in self.__ecom.cells.find():
+            registry.update(cell['_id'], cell)
+
+    def watch_cells(self, registry):
+        """Load the `cells` collection into `registry` and keep it in sync.
+
+        Changes arrive over a change stream on a background thread, so lookups
+        never query the database. Change streams need a replica set; on a
+        standalone server the registry keeps the snapshot loaded here.
+        """
+        self.load_cells(registry)
+        thread = threading.Thread(target=self.__watch_cells, args=(registry,), name="mongo-cells-watch", daemon=True)
+        thread.start()
+        return thread
+
+    def __watch_cells(self, registry):
+        resume_token = None
+        while True:
+            try:
+                with self.__ecom.cells.watch(full_document='updateLookup', resume_after=resume_token) as stream:
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        cell_id = change['documentKey']['_id']
+                        if change['operationType'] == 'delete':
+                            registry.remove(cell_id)
+                        elif change.get('fullDocument'):
+                            registry.update(cell_id, change['fullDocument'])
+            except pm.errors.OperationFailure as e:
+                logging.warning('Cells change stream unavailable, using the loaded snapshot: %s', e)
+                return
+            except pm.errors.PyMongoError as e:
+                logging.warning('Cells change stream failed, reopening: %s', e)
+                time.sleep(WATCH_RETRY_INTERVAL)
+
+    def ensure_indexes(self):
+        # Every filter the controller writes or reads with has an index behind it;
+        # orders and archive_orders are looked up by _id, which always has one
+        self.__ecom.robots.create_index('robot_id')
+        self.__ecom.orders.create_index([('status', pm.ASCENDING), (ORDER_CREATED_FIELD, pm.ASCENDING)])
+
+    def __supports_transactions(self):
+        # Transactions need a replica set or mongos; a standalone server has neither
+        if self.__transactions is None:
+            hello = self.__client.admin.command('hello')
+            self.__transactions = 'setName' in hello or hello.get('msg') == 'isdbgrid'
+        return self.__transactions
 
     def archivate_order(self, order_id):
-        order = self.__ecom.orders.find_one({"_id": order_id})
-        response = self.__ecom.archive_orders.insert_one(order)
-        if response:
-            self.__ecom.orders.delete_one({"_id": order["_id"]})
\ No newline at end of file
+        # The archived copy must include any status still waiting to be flushed;
+        # bounded, so a stuck writer cannot hold up the mission
+        if not self.flush(ARCHIVE_FLUSH_TIMEOUT):
+            logging.warning('Archiving %s before its queued updates were flushed', order_id)
+        with self.__changed:
+            if self.__draining:
+                self.__outbox.append('archive', 'archive_orders', '_id', order_id)
+                return
+        try:
+            with self.__timed('archive_orders'):
+                self.__archive(order_id)
+        except pm.errors.ConnectionFailure as e:
+            logging.warning('Mongo unreachable, archiving %s from the outbox: %s', order_id, e)
+            with self.__changed:
+                self.__outbox.append('archive', 'archive_orders', '_id', order_id)
+                self.__start_draining()
+
+    def __archive(self, order_id):
+        if self.__supports_transactions():
+            with self.__client.start_session() as session:
+                session.with_transaction(lambda session: self.__archive_in_transaction(order_id, session))
+        else:
+            # $merge copies the order server-side and is idempotent, so a retry
+            # after a failure between the two steps cannot duplicate the archive
+            self.__ecom.orders.aggregate([
+                {'$match': {'_id': order_id}},
+                {'$merge': {'into': 'archive_orders', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+            ])
+            self.__ecom.orders.delete_one({'_id': order_id})
+
+    @contextmanager
+    def __timed(self, collection):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            MONGO_WRITE.labels(collection).observe(time.perf_counter() - started)
+
+    def __archive_in_transaction(self, order_id, session):
+        order = self.__ecom.orders.find_one_and_delete({'_id': order_id}, session=session)
+        if order:
+            self.__ecom.archive_orders.insert_one(order, session=session)
@@ -0,0 +1,154 @@
+"""Motion profiles and timing models from recorded telemetry.
+
+Splits the recorded position of each axis into individual moves and reports
+each move's distance, duration, peak speed, acceleration and settle time. It
+then fits a per-axis model, move time = overhead + distance * seconds_per_unit:
+
+    python motion_analysis.py recordings/20261017-101500 recordings/20261018-090000
+    python motion_analysis.py recordings/* --write
+
+--write saves the fit to motion_model.json. The planner then uses it for leg
+times and timeouts, mission routes use it for lift timeouts, and the job
+queue uses it for its initial ETAs.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from mission import MOTION_MODEL_FILE
+from recorder import load_session
+from serial_transport import ARRIVAL_TOLERANCE
+
+# Below this speed (units per second) an axis counts as standing still
+STILL_SPEED = {"x": 5.0, "y": 5.0, "z": 0.01}
+# Shorter moves are jitter or corrections, not moves worth fitting
+MIN_DISTANCE = {"x": 20.0, "y": 20.0, "z": 0.1}
+# Pauses shorter than this inside a move (a noisy sample) do not split it
+MAX_PAUSE = 0.3
+MIN_MOVES = 3
+
+
+def segment_moves(t, position, still_speed, min_distance, max_pause=MAX_PAUSE):
+    """Start and end sample indices of every move in one axis' samples."""
+    speed = np.abs(np.diff(position)) / np.maximum(np.diff(t), 1e-6)
+    moving = np.concatenate(([False], speed > still_speed, [False]))
+    edges = np.diff(moving.astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if len(starts) == 0:
+        return starts, ends
+    # Join moves separated by a short pause
+    joined = t[starts[1:]] - t[ends[:-1]] < max_pause
+    starts = starts[np.concatenate(([True], ~joined))]
+    ends = ends[np.concatenate((~joined, [True]))]
+    long_enough = np.abs(position[ends] - position[starts]) >= min_distance
+    return starts[long_enough], ends[long_enough]
+
+
+def move_profiles(t, position, starts, ends, tolerance):
+    """Per-move columns: distance, duration, peak speed, acceleration, settle time.
+
+    Acceleration is the average up to 90% of the peak speed; settle time is
+    how long the axis spends inside the arrival tolerance before it stops.
+    """
+    if len(starts) == 0:
+        return {name: np.array([]) for name in ("distance", "duration", "peak_speed", "acceleration", "settle")}
+    dt = np.maximum(np.diff(t), 1e-6)
+    speed = np.abs(np.diff(position)) / dt
+    index = np.arange(len(t))
+    # Which move every sample belongs to, -1 outside moves
+    owner = np.full(len(t), -1)
+    owner_edges = np.zeros(len(t) + 1, dtype=int)
+    np.add.at(owner_edges, starts, 1)
+    np.add.at(owner_edges, ends + 1, -1)
+    inside = np.cumsum(owner_edges)[:-1] > 0
+    owner[inside] = np.searchsorted(starts, index[inside], side="right") - 1
+
+    in_move = owner[:-1] >= 0
+    move_speed = np.where(in_move, speed, 0.0)
+    peak = np.maximum.reduceat(move_speed, starts)
+    fast = in_move & (move_speed >= 0.9 * peak[np.maximum(owner[:-1], 0)])
+    ramp_end = np.minimum.reduceat(np.where(fast, index[:-1], len(t)), starts)
+    # The 90% speed is reached by the end of that sample interval
+    ramp = np.maximum(t[np.minimum(ramp_end + 1, len(t) - 1)] - t[starts], 1e-6)
+
+    final = position[ends]
+    settled = (owner >= 0) & (np.abs(position - final[np.maximum(owner, 0)]) <= tolerance)
+    first_settled = np.minimum.reduceat(np.where(settled, index, len(t) - 1), starts)
+    return {
+        "distance": np.abs(final - position[starts]),
+        "duration": t[ends] - t[starts],
+        "peak_speed": peak,
+        "acceleration": 0.9 * peak / ramp,
+        "settle": t[ends] - t[np.minimum(first_settled, ends)],
+    }
+
+
+def fit_axis(profiles):
+    # Least squares of duration on distance; None when there is too little to fit
+    distance, duration = profiles["distance"], profiles["duration"]
+    if len(distance) < MIN_MOVES:
+        return None
+    if np.ptp(distance) > 0:
+        seconds_per_unit, overhead = np.polyfit(distance, duration, 1)
+    else:
+        seconds_per_unit, overhead = np.mean(duration / distance), 0.0
+    overhead = max(overhead, 0.0)
+    residual = duration - (overhead + seconds_per_unit * distance)
+    return {
+        "overhead": round(float(overhead), 4),
+        "seconds_per_unit": float(seconds_per_unit),
+        "residual": round(float(np.std(residual)), 4),
+        "moves": int(len(distance)),
+        "peak_speed": round(float(np.median(profiles["peak_speed"])), 4),
+        "acceleration": round(float(np.median(profiles["acceleration"])), 4),
+        "settle": round(float(np.median(profiles["settle"])), 4),
+    }
+
+
+def analyze(sessions):
+    # Profiles per axis over all sessions; moves never span two sessions
+    profiles = {axis: [] for axis in "xyz"}
+    for session in sessions:
+        _, samples, _ = load_session(session)
+        t = samples["t"]
+        if len(t) < 2:
+            continue
+        for i, axis in enumerate("xyz"):
+            position = samples[axis]
+            starts, ends = segment_moves(t, position, STILL_SPEED[axis], MIN_DISTANCE[axis])
+            profiles[axis].append(move_profiles(t, position, starts, ends, ARRIVAL_TOLERANCE[i]))
+    return {
+        axis: {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+        for axis, parts in profiles.items() if parts
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit per-axis motion timing models from recorded sessions")
+    parser.add_argument("sessions", nargs="+", help="Session directories under recordings/")
+    parser.add_argument("--write", action="store_true", help=f"Save the fitted model to {MOTION_MODEL_FILE}")
+    args = parser.parse_args()
+
+    fits = {}
+    for axis, profiles in analyze(args.sessions).items():
+        fit = fit_axis(profiles)
+        if fit is None:
+            print(f"{axis}: {len(profiles['distance'])} moves, too few to fit")
+            continue
+        fits[axis] = fit
+        print(
+            f"{axis}: {fit['moves']} moves, {fit['overhead']:.2f}s + {fit['seconds_per_unit']:.5f}s per unit "
+            f"(±{fit['residual']:.2f}s), peak {fit['peak_speed']:.3f}/s, accel {fit['acceleration']:.3f}/s², "
+            f"settle {fit['settle']:.2f}s"
+        )
+    if args.write and fits:
+        with open(MOTION_MODEL_FILE, "w") as f:
+            json.dump({"fitted": time.strftime("%Y-%m-%d %H:%M:%S"), "sessions": args.sessions, "axes": fits}, f, indent=2)
+        print(f"Saved {MOTION_MODEL_FILE}")
+
+
+if __name__ == "__main__":
+    main()
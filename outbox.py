@@ -0,0 +1,47 @@
+"""Durable FIFO of database writes that could not reach Mongo.
+
+Kept in a local SQLite file so writes queued during an outage survive a
+restart. Each write is committed on its own before append() returns. Values
+are stored as extended JSON, so ObjectIds and dates come back as they went in.
+"""
+import sqlite3
+import threading
+import time
+
+from bson import json_util
+
+
+class Outbox:
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT, collection TEXT, key TEXT, value TEXT,"
+            " fields TEXT, queued_at REAL)"
+        )
+        self._lock = threading.Lock()
+
+    def append(self, op, collection, key, value, fields=None):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO outbox (op, collection, key, value, fields, queued_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (op, collection, key, json_util.dumps(value), json_util.dumps(fields or {}), time.time()),
+            )
+
+    def peek(self, limit=100):
+        # Oldest first: (id, op, collection, key, value, fields)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, op, collection, key, value, fields FROM outbox ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        return [(row_id, op, collection, key, json_util.loads(value), json_util.loads(fields))
+                for row_id, op, collection, key, value, fields in rows]
+
+    def remove(self, row_id):
+        with self._lock:
+            self._db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
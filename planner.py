@@ -0,0 +1,248 @@
+import heapq
+import itertools
+from collections import namedtuple
+from functools import lru_cache
+
+CHASSIS_COMMANDS = {"stable": "POLO,0", "x": "POLO,1", "y": "POLO,2"}
+AXIS_COMMANDS = {"x": "MOVX", "y": "MOVY", "z": "LIFT"}
+
+# Relative direction names used by send_movement_command: (axis, sign)
+DIRECTIONS = {
+    "forward": ("x", 1), "backward": ("x", -1),
+    "left": ("y", 1), "right": ("y", -1),
+    "up": ("z", 1), "down": ("z", -1),
+}
+
+# Allowed deviation between commanded and reported X, Y, Z before a move counts as done
+ARRIVAL_TOLERANCE = (5.0, 5.0, 0.05)
+
+# Planned legs get this much slack before a move counts as timed out
+TIMEOUT_FACTOR = 2.0
+TIMEOUT_MARGIN = 5.0
+
+# With a fitted motion model the spread of measured moves is known, so the
+# slack is a few standard deviations instead of a blanket factor
+MODEL_TIMEOUT_SIGMAS = 4.0
+MODEL_TIMEOUT_MARGIN = 1.0
+
+# A straight run the chassis can drive: along `axis`, at fixed other-axis
+# coordinate `at`, between `start` and `end` on the travel axis. `aisle` names
+# it for reservations between robots.
+Track = namedtuple("Track", ["axis", "at", "start", "end", "aisle"], defaults=(None,))
+
+
+def aisle_name(track):
+    return track.aisle or f"{track.axis}{track.at}"
+
+
+def junction_name(point):
+    return f"{point[0]},{point[1]}"
+
+# One move along a single axis to an absolute target, with its planned time
+Leg = namedtuple("Leg", ["axis", "target", "duration"])
+
+
+
+class AxisModel(namedtuple("AxisModel", ["overhead", "seconds_per_unit", "residual"])):
+    """Move time fitted from recorded telemetry (see motion_analysis.py):
+    `overhead` seconds per move plus `seconds_per_unit` per unit travelled,
+    with `residual` the standard deviation of the fit."""
+
+    def time(self, distance):
+        return self.overhead + abs(distance) * self.seconds_per_unit
+
+    def timeout(self, duration):
+        return round(duration + MODEL_TIMEOUT_SIGMAS * self.residual + MODEL_TIMEOUT_MARGIN, 1)
+
+
+class PlanError(Exception):
+    pass
+
+
+def on_track(track, point):
+    x, y = point
+    along, across = (x, y) if track.axis == "x" else (y, x)
+    return across == track.at and min(track.start, track.end) <= along <= max(track.start, track.end)
+
+
+def intersection(a, b):
+    if a.axis == b.axis:
+        return None
+    x_track, y_track = (a, b) if a.axis == "x" else (b, a)
+    point = (y_track.at, x_track.at)
+    if on_track(x_track, point) and on_track(y_track, point):
+        return point
+    return None
+
+
+class RackGrid:
+    """The rack as a set of X/Y tracks with per-axis speeds.
+
+    Plans the fastest sequence of single-axis legs between two points, counting
+    `chassis_switch_time` whenever the chassis has to change between x and y
+    mode and `leg_overhead` for every leg (acceleration and settling). Axes
+    with an AxisModel in `motion_model` use the fitted move time instead.
+    """
+
+    def __init__(self, tracks, speeds, chassis_switch_time, leg_overhead=0.0, motion_model=None):
+        self.tracks = tuple(tracks)
+        self.speeds = speeds
+        self.chassis_switch_time = chassis_switch_time
+        self.leg_overhead = leg_overhead
+        self.motion_model = motion_model or {}
+        self.junctions = {
+            point for a, b in itertools.combinations(self.tracks, 2)
+            for point in [intersection(a, b)] if point
+        }
+
+    @classmethod
+    def from_layout(cls, layout, motion_model=None):
+        tracks = [Track(**track) for track in layout["tracks"]]
+        return cls(
+            tracks, layout["speeds"], layout["chassis_switch_time"], layout.get("leg_overhead", 0.0), motion_model,
+        )
+
+    def leg_time(self, axis, start, target):
+        if axis in self.motion_model:
+            return self.motion_model[axis].time(target - start)
+        return self.leg_overhead + abs(target - start) / self.speeds[axis]
+
+    def leg_timeout(self, leg):
+        if leg.axis in self.motion_model:
+            return self.motion_model[leg.axis].timeout(leg.duration)
+        return leg_timeout(leg)
+
+    def move_timeout(self, axis, start, target):
+        # Fitted timeout for a move outside the planner (lift moves); None without a model
+        if axis not in self.motion_model:
+            return None
+        return self.motion_model[axis].timeout(self.motion_model[axis].time(target - start))
+
+    def contains(self, point):
+        return any(on_track(track, point) for track in self.tracks)
+
+    def snap(self, point, tolerance=ARRIVAL_TOLERANCE[:2]):
+        """The closest junction or track end within `tolerance` of a measured
+        `point`, else the closest point on a track; None if it is off the tracks."""
+        x, y = point
+
+        def near(candidates):
+            within = [c for c in candidates if abs(c[0] - x) <= tolerance[0] and abs(c[1] - y) <= tolerance[1]]
+            return min(within, key=lambda c: abs(c[0] - x) + abs(c[1] - y), default=None)
+
+        ends = {
+            (end, track.at) if track.axis == "x" else (track.at, end)
+            for track in self.tracks for end in (track.start, track.end)
+        }
+        on_tracks = []
+        for track in self.tracks:
+            along = x if track.axis == "x" else y
+            along = min(max(along, min(track.start, track.end)), max(track.start, track.end))
+            on_tracks.append((along, track.at) if track.axis == "x" else (track.at, along))
+        return near(self.junctions | ends) or near(on_tracks)
+
+    def aisles_at(self, point):
+        # A robot at a junction holds just the junction, elsewhere the track it is on
+        if point in self.junctions:
+            return {junction_name(point)}
+        return {aisle_name(track) for track in self.tracks if on_track(track, point)}
+
+    def aisles_between(self, start, target):
+        # Tracks a single-axis move drives along and junctions it crosses, both ends included
+        aisles = self.aisles_at(start) | self.aisles_at(target)
+        axis = "x" if start[0] != target[0] else "y"
+        index = 0 if axis == "x" else 1
+        low, high = sorted((start[index], target[index]))
+        for track in self.tracks:
+            if track.axis != axis or track.at != start[1 - index]:
+                continue
+            if min(track.start, track.end) < high and low < max(track.start, track.end):
+                aisles.add(aisle_name(track))
+        for junction in self.junctions:
+            if all(min(a, b) <= c <= max(a, b) for a, b, c in zip(start, target, junction)):
+                aisles.add(junction_name(junction))
+        return aisles
+
+    def plan(self, start, goal, chassis=None):
+        start, goal = tuple(start), tuple(goal)
+        return self._plan(start, goal, chassis)
+
+    @lru_cache(maxsize=1024)
+    def _plan(self, start, goal, chassis):
+        for point in (start, goal):
+            if not self.contains(point):
+                raise PlanError(f"Point {point} is not on any track")
+        nodes = self.junctions | {start, goal}
+        by_track = [(track, [node for node in nodes if on_track(track, node)]) for track in self.tracks]
+
+        # Dijkstra over (point, chassis mode), so switches are paid where they happen
+        counter = itertools.count()
+        best = {(start, chassis): 0.0}
+        previous = {}
+        heap = [(0.0, next(counter), start, chassis)]
+        while heap:
+            cost, _, point, mode = heapq.heappop(heap)
+            if point == goal:
+                return self._legs(previous, (point, mode)), cost
+            if cost > best.get((point, mode), float("inf")):
+                continue
+            for track, members in by_track:
+                if point not in members:
+                    continue
+                index = 0 if track.axis == "x" else 1
+                for other in members:
+                    if other == point:
+                        continue
+                    step = self.leg_time(track.axis, point[index], other[index])
+                    if mode != track.axis:
+                        step += self.chassis_switch_time
+                    state = (other, track.axis)
+                    if cost + step < best.get(state, float("inf")):
+                        best[state] = cost + step
+                        previous[state] = (point, mode)
+                        heapq.heappush(heap, (cost + step, next(counter), other, track.axis))
+        raise PlanError(f"No route from {start} to {goal}")
+
+    def _legs(self, previous, state):
+        states = [state]
+        while state in previous:
+            state = previous[state]
+            states.append(state)
+        states.reverse()
+        # Straight on along two tracks of one line (an aisle boundary) is a single leg
+        legs = []
+        for (prior, _), (point, mode) in zip(states, states[1:]):
+            index = 0 if mode == "x" else 1
+            if legs and legs[-1].axis == mode:
+                legs[-1] = Leg(mode, point[index], self.leg_time(mode, leg_start[index], point[index]))
+            else:
+                leg_start = prior
+                legs.append(Leg(mode, point[index], self.leg_time(mode, prior[index], point[index])))
+        return legs
+
+
+def leg_timeout(leg):
+    return round(leg.duration * TIMEOUT_FACTOR + TIMEOUT_MARGIN, 1)
+
+
+def legs_to_steps(legs, chassis=None, timeout=leg_timeout):
+    # Mission steps for a planned route, one chassis change per axis switch
+    steps = []
+    for leg in legs:
+        if leg.axis != chassis:
+            steps.append({"action": "chassis", "mode": leg.axis})
+            chassis = leg.axis
+        steps.append({"action": "goto", "axis": leg.axis, "position": leg.target, "timeout": timeout(leg)})
+    return steps
+
+
+def legs_to_commands(legs, chassis=None):
+    # The ESP32 command stream for a planned route, as change_chassis and
+    # send_movement_command would write it
+    commands = []
+    for step in legs_to_steps(legs, chassis):
+        if step["action"] == "chassis":
+            commands.append(CHASSIS_COMMANDS[step["mode"]])
+        else:
+            commands.append(f"{AXIS_COMMANDS[step['axis']]},{step['position']:.4f}")
+    return commands
@@ -0,0 +1,109 @@
+"""Commanded targets and measured position of the robot in one object.
+
+Targets are absolute rack coordinates. Relative moves are applied to the
+target, not to wherever the robot happened to stop, so errors do not add up
+over a shift. Each time an axis settles, its error against the target is
+folded into a per-axis bias. Later commands for that axis are sent
+pre-compensated by the bias, and an axis that settles further than
+CORRECTION_THRESHOLD from its target gets a corrective move.
+"""
+import threading
+
+AXES = ("x", "y", "z")
+# Settled error per axis that still calls for a corrective move
+CORRECTION_THRESHOLD = {"x": 1.0, "y": 1.0, "z": 0.01}
+# Further off than this and the axis is not settling near its target at all:
+# leave it to the arrival timeout instead of correcting
+CORRECTION_RANGE = {"x": 20.0, "y": 20.0, "z": 0.2}
+MAX_CORRECTIONS = 2
+# How fast the bias follows new errors
+BIAS_SMOOTHING = 0.3
+
+
+def at_rest(previous, snapshot):
+    # Two consecutive samples this close mean the axes have stopped moving
+    return all(
+        abs(a - b) <= CORRECTION_THRESHOLD[axis] / 2
+        for axis, a, b in zip(AXES, previous[:3], snapshot[:3])
+    )
+
+
+class PositionManager:
+    def __init__(self, telemetry, registry=None):
+        self.telemetry = telemetry
+        self.registry = registry
+        self.targets = {axis: 0.0 for axis in AXES}
+        self.sent = {axis: 0.0 for axis in AXES}
+        # Learned per axis and direction: drives often stop short the same way
+        self.bias = {(axis, sign): 0.0 for axis in AXES for sign in (1, -1)}
+        self._moves = {}
+        self._lock = threading.Lock()
+
+    @property
+    def measured(self):
+        return self.telemetry.latest
+
+    def target(self):
+        with self._lock:
+            return tuple(self.targets[axis] for axis in AXES)
+
+    def sync_to_measured(self):
+        # Adopt the reported position as the target, e.g. at startup
+        snapshot = self.telemetry.latest
+        if snapshot is None:
+            return False
+        with self._lock:
+            for axis, value in zip(AXES, snapshot[:3]):
+                self.targets[axis] = self.sent[axis] = value
+            self._moves.clear()
+        return True
+
+    def set_target(self, axis, position):
+        """Record a new absolute target; returns the value to send to the firmware."""
+        with self._lock:
+            sign = 1 if position >= self.targets[axis] else -1
+            snapshot = self.telemetry.latest
+            origin = snapshot[AXES.index(axis)] if snapshot else self.targets[axis]
+            self.targets[axis] = position
+            self.sent[axis] = position - self.bias[(axis, sign)]
+            # (direction, where the move started, whether it is a correction)
+            self._moves[axis] = (sign, origin, False)
+            return self.sent[axis]
+
+    def offset_target(self, axis, distance):
+        with self._lock:
+            return self.targets[axis] + distance
+
+    def named(self, name):
+        # A registry location such as "home_x", "port.z" or "A1.buffer_y"
+        if self.registry is None:
+            raise KeyError(f"No rack layout for named position {name}")
+        return self.registry.location(name)
+
+    def settled(self, snapshot):
+        """Learn from axes that have come to rest near their target.
+
+        Returns {axis: value to send} for axes that stopped further than
+        CORRECTION_THRESHOLD off. A correction is a short move, so it is sent
+        to the plain target and is not learned from.
+        """
+        corrections = {}
+        with self._lock:
+            for axis, measured in zip(AXES, snapshot[:3]):
+                if axis not in self._moves:
+                    continue
+                sign, origin, correcting = self._moves[axis]
+                error = measured - self.targets[axis]
+                if abs(error) > CORRECTION_RANGE[axis] or abs(measured - origin) <= CORRECTION_THRESHOLD[axis]:
+                    # Far off, or still resting where it started
+                    continue
+                if not correcting:
+                    drift = measured - self.sent[axis]
+                    key = (axis, sign)
+                    self.bias[key] = (1 - BIAS_SMOOTHING) * self.bias[key] + BIAS_SMOOTHING * drift
+                del self._moves[axis]
+                if abs(error) > CORRECTION_THRESHOLD[axis]:
+                    self.sent[axis] = self.targets[axis]
+                    self._moves[axis] = (sign, measured, True)
+                    corrections[axis] = self.sent[axis]
+        return corrections
@@ -0,0 +1,109 @@
+"""Session recorder for telemetry samples and serial traffic.
+
+Samples and lines are queued in memory by the serial threads and written by a
+background thread as numbered chunks of column arrays, so the live loop never
+waits on the disk:
+
+    recordings/<session>/meta.json
+    recordings/<session>/samples-000000.npz   t, x, y, z, stopped_by_sensor
+    recordings/<session>/events-000000.npz    t, port, direction, line
+
+Times are time.monotonic() seconds; meta.json maps them to wall-clock time.
+Chunks are only ever added, so a crash loses at most the last interval.
+Load a session with load_session(), or replay it with replay.py.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+RECORDINGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings")
+FLUSH_INTERVAL = 5.0
+
+SAMPLE_COLUMNS = ("t", "x", "y", "z", "stopped_by_sensor")
+EVENT_COLUMNS = ("t", "port", "direction", "line")
+
+
+class Recorder:
+    def __init__(self, directory=None, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory or os.path.join(RECORDINGS_DIR, time.strftime("%Y%m%d-%H%M%S"))
+        self.flush_interval = flush_interval
+        # deque appends and pops are atomic, so recording takes no lock
+        self._samples = deque()
+        self._events = deque()
+        self._chunk = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "meta.json"), "w") as f:
+            json.dump({"monotonic": time.monotonic(), "wall": time.time()}, f)
+        self._thread = threading.Thread(target=self._write_loop, name="recorder", daemon=True)
+        self._thread.start()
+        print(f"Recording session to {self.directory}")
+        return self
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def record_sample(self, position):
+        self._samples.append((position.timestamp, position.x, position.y, position.z, position.stopped_by_sensor))
+
+    def record_event(self, port, direction, line):
+        self._events.append((time.monotonic(), port, direction, line))
+
+    def _write_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        samples = [self._samples.popleft() for _ in range(len(self._samples))]
+        events = [self._events.popleft() for _ in range(len(self._events))]
+        if not samples and not events:
+            return
+        try:
+            if samples:
+                t, x, y, z, flags = zip(*samples)
+                self._save("samples", t=np.array(t), x=np.array(x), y=np.array(y), z=np.array(z),
+                           stopped_by_sensor=np.array(flags, dtype=np.uint8))
+            if events:
+                t, port, direction, line = zip(*events)
+                self._save("events", t=np.array(t), port=np.array(port), direction=np.array(direction),
+                           line=np.array(line))
+        except OSError as e:
+            # A full or missing disk must not stop the robot; the chunk is lost
+            print(f"Recorder failed to write chunk {self._chunk}: {e}")
+        self._chunk += 1
+
+    def _save(self, kind, **columns):
+        np.savez_compressed(os.path.join(self.directory, f"{kind}-{self._chunk:06d}.npz"), **columns)
+
+
+def load_chunks(directory, kind, columns):
+    parts = {column: [] for column in columns}
+    for path in sorted(glob.glob(os.path.join(directory, f"{kind}-*.npz"))):
+        with np.load(path) as chunk:
+            for column in columns:
+                parts[column].append(chunk[column])
+    if not parts["t"]:
+        return {column: np.array([]) for column in columns}
+    return {column: np.concatenate(arrays) for column, arrays in parts.items()}
+
+
+def load_session(directory):
+    # (meta, samples, events); samples and events are dicts of column arrays
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    return meta, load_chunks(directory, "samples", SAMPLE_COLUMNS), load_chunks(directory, "events", EVENT_COLUMNS)
@@ -0,0 +1,158 @@
+"""Inspect or replay a session recorded with RECORD_TELEMETRY=1.
+
+    python replay.py recordings/20261017-101500
+    python replay.py recordings/20261017-101500 --start 30 --route delivery --cell A1
+
+Without --route, prints a summary of the session: sample rate, telemetry gaps,
+commands and rejections. With --route, the recorded samples are served as
+AK80 lines on a pseudo-terminal at their original pace, and the compiled
+route runs against them through RobotLink and MissionRunner. This shows
+which step would stall or time out on that telemetry. Order and status steps
+are skipped.
+"""
+import argparse
+import os
+import select
+import threading
+import time
+
+import numpy as np
+
+from benchmark import describe
+from esp_simulator import open_pty
+from mission import ORDER_ACTIONS, MissionRunner, compiled_route, without_actions
+from recorder import load_session
+from serial_transport import CommandFailed, MotionTimeout, RobotLink
+
+# Gaps between samples longer than this are listed in the summary
+GAP_THRESHOLD = 0.5
+
+
+class ReplayBoard:
+    """Plays recorded samples back on a pty and collects what the host sends."""
+
+    def __init__(self, samples, speed=1.0):
+        self.samples = samples
+        self.speed = speed
+        self.received = []
+        self.finished = threading.Event()
+        self._esp32_master, self._esp32_slave, self.esp32_port = open_pty()
+        self._nano_master, self._nano_slave, self.nano_port = open_pty()
+        self._buffers = {self._esp32_master: b"", self._nano_master: b""}
+        self._running = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="replay", daemon=True)
+
+    def start(self):
+        self._running.set()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running.clear()
+        self._thread.join()
+        for fd in (self._esp32_master, self._esp32_slave, self._nano_master, self._nano_slave):
+            os.close(fd)
+
+    def _read(self, timeout):
+        readable, _, _ = select.select(list(self._buffers), [], [], max(timeout, 0.0))
+        for fd in readable:
+            try:
+                self._buffers[fd] += os.read(fd, 1024)
+            except (BlockingIOError, OSError):
+                continue
+            *lines, self._buffers[fd] = self._buffers[fd].split(b"\n")
+            port = "ESP32" if fd == self._esp32_master else "NANO"
+            for line in lines:
+                line = line.decode("utf-8", errors="ignore").strip()
+                if line:
+                    self.received.append((time.monotonic(), port, line))
+
+    def _run(self):
+        t = self.samples["t"]
+        started = time.monotonic()
+        for i in range(len(t)):
+            due = started + (t[i] - t[0]) / self.speed
+            while self._running.is_set() and time.monotonic() < due:
+                self._read(due - time.monotonic())
+            if not self._running.is_set():
+                return
+            line = (
+                f"AK80,{self.samples['x'][i]:.4f},{self.samples['y'][i]:.4f},"
+                f"{self.samples['z'][i]:.4f},{int(self.samples['stopped_by_sensor'][i])}\n"
+            )
+            try:
+                os.write(self._esp32_master, line.encode())
+            except BlockingIOError:
+                pass
+        self.finished.set()
+        while self._running.is_set():
+            self._read(0.1)
+
+
+def window(columns, start, end):
+    keep = (columns["t"] >= start) & (columns["t"] <= end)
+    return {name: values[keep] for name, values in columns.items()}
+
+
+def summarize(samples, events):
+    t = samples["t"]
+    if len(t) < 2:
+        print(f"{len(t)} samples, nothing to summarize")
+        return
+    duration = t[-1] - t[0]
+    gaps = np.diff(t)
+    print(f"{len(t)} samples over {duration:.1f}s, {len(t) / duration:.1f} Hz, median interval {np.median(gaps) * 1000:.0f} ms")
+    for i in np.flatnonzero(gaps > GAP_THRESHOLD):
+        print(f"  gap of {gaps[i]:.2f}s at +{t[i] - t[0]:.1f}s")
+    sent = events["direction"] == "tx"
+    print(f"{int(sent.sum())} lines sent, {int((~sent).sum())} received")
+    for when, port, line in zip(events["t"][~sent], events["port"][~sent], events["line"][~sent]):
+        if line.startswith("NAK"):
+            print(f"  +{when - t[0]:.1f}s {port} {line}")
+    print(f"Last position: X {samples['x'][-1]:.2f}, Y {samples['y'][-1]:.2f}, Z {samples['z'][-1]:.3f}")
+
+
+def replay_route(samples, route, cell_id, speed):
+    board = ReplayBoard(samples, speed).start()
+    link = RobotLink(board.esp32_port, board.nano_port).start()
+    try:
+        link.initialize_positions()
+        runner = MissionRunner(link)
+        for step in without_actions(compiled_route(route, cell_id), ORDER_ACTIONS):
+            started = time.monotonic()
+            try:
+                runner.execute(step, None)
+            except (MotionTimeout, CommandFailed) as e:
+                print(f"  FAILED after {time.monotonic() - started:.2f}s  {describe(step)}: {e}")
+                break
+            print(f"  {time.monotonic() - started:8.2f}s  {describe(step)}")
+    finally:
+        link.close()
+        board.stop()
+    print(f"Host sent {sum(1 for _, port, _ in board.received if port == 'ESP32')} ESP32 lines during the replay")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize or replay a recorded telemetry session")
+    parser.add_argument("session", help="Session directory under recordings/")
+    parser.add_argument("--start", type=float, default=0.0, help="Seconds after the first sample to start from")
+    parser.add_argument("--end", type=float, default=float("inf"), help="Seconds after the first sample to stop at")
+    parser.add_argument("--route", help="Run this route against the recorded telemetry")
+    parser.add_argument("--cell", default="A1")
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed factor")
+    args = parser.parse_args()
+
+    _, samples, events = load_session(args.session)
+    if not len(samples["t"]):
+        print("No samples recorded")
+        return
+    origin = samples["t"][0]
+    samples = window(samples, origin + args.start, origin + args.end)
+    events = window(events, origin + args.start, origin + args.end)
+    summarize(samples, events)
+    if args.route:
+        replay_route(samples, args.route, args.cell, args.speed)
+
+
+if __name__ == "__main__":
+    main()
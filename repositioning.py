@@ -0,0 +1,80 @@
+"""Where the robot waits between jobs.
+
+Routes are compiled from wherever the previous job left the robot, as
+measured by telemetry (see mission.route_start). A delivery queued behind a
+return therefore drives straight from the return cell to its pick cell. When
+the queue stays empty
+for PARK_DELAY seconds, the robot parks at the hot spot. That is the point
+with the least expected travel to the start of the next job, judging by
+recent jobs.
+"""
+import threading
+from collections import deque
+
+from mission import RouteError, cell_registry, compile_route, home_position, load_route, rack_grid, route_start
+
+# Seconds the job queue must stay empty before the robot moves to park
+PARK_DELAY = 10.0
+HISTORY_LENGTH = 50
+# Weight of a job relative to the one after it, so recent demand counts most
+HISTORY_DECAY = 0.9
+
+
+def first_stop(steps, start):
+    # Where a route first works the lift: the spot the job needs the robot at
+    position = {"x": start[0], "y": start[1]}
+    for step in steps:
+        for inner in [step] + [inner for branch in step.get("branches", ()) for inner in branch]:
+            if inner["action"] != "goto":
+                continue
+            if inner["axis"] == "z":
+                return (position["x"], position["y"])
+            position[inner["axis"]] = inner["position"]
+    return (position["x"], position["y"])
+
+
+class Repositioner:
+    def __init__(self, robot, overrides=()):
+        self.robot = robot
+        self.overrides = overrides
+        self.history = deque(maxlen=HISTORY_LENGTH)
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Where the robot is, not where it was told to go: after an aborted lift
+        # move the target is already travel height while the lift is still down
+        snapshot = self.robot.positions.measured
+        if snapshot is None:
+            raise RouteError("No position reported by the ESP32 yet; home the robot first")
+        return route_start(tuple(snapshot[:3]), self.overrides)
+
+    def record(self, steps, start):
+        with self._lock:
+            self.history.append(first_stop(steps, start))
+
+    def hot_spot(self):
+        with self._lock:
+            history = list(self.history)
+        if not history:
+            return home_position(self.overrides)[:2]
+        weights = {}
+        for age, point in enumerate(reversed(history)):
+            weights[point] = weights.get(point, 0.0) + HISTORY_DECAY ** age
+        grid = rack_grid()
+
+        def expected_travel(candidate):
+            return sum(
+                weight * (0.0 if candidate == point else grid.plan(candidate, point)[1])
+                for point, weight in weights.items()
+            )
+
+        return min(weights, key=expected_travel)
+
+    def park_route(self):
+        # Steps to the hot spot; empty when the robot is already there
+        start = self.start()
+        spot = self.hot_spot()
+        if start[:2] == spot:
+            return ()
+        params = dict(cell_registry().params, **dict(self.overrides), park_x=spot[0], park_y=spot[1])
+        return compile_route(load_route("park"), params, rack_grid(), start, "stable")
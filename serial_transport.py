@@ -0,0 +1,474 @@
+import itertools
+import os
+import queue
+import threading
+import time
+
+import serial
+
+from metrics import SERIAL_WRITE
+from planner import ARRIVAL_TOLERANCE, AXIS_COMMANDS, CHASSIS_COMMANDS, DIRECTIONS
+from position_manager import MAX_CORRECTIONS, PositionManager, at_rest
+from telemetry import BINARY_FRAME, BINARY_HANDSHAKE, BINARY_SYNC, TelemetryReader
+
+# Override with the environment to run against esp_simulator.py
+ESP32_PORT = os.environ.get('ESP32_PORT', '/dev/ttyUSB0')
+ARDUINO_PORT = os.environ.get('ARDUINO_PORT', '/dev/ttyUSB1')
+BAUD_RATE_ESP = 19200
+BAUD_RATE_NANO = 9600
+
+# Short read timeout: lines are framed from whatever bytes have arrived, so
+# the reader never sits in readline() waiting for a full line
+READ_TIMEOUT = 0.05
+WRITE_TIMEOUT = 1
+RECONNECT_INTERVAL = 1.0
+MAX_LINE_LENGTH = 256
+# pyserial raises TypeError/AttributeError when the port is closed under a
+# read or write, e.g. by the reader thread dropping the connection
+PORT_ERRORS = (serial.SerialException, OSError, TypeError, AttributeError)
+
+CHASSIS_SETTLE_TIME = 2
+# Homing is done with the first position frame; give up waiting for it after this
+HOMING_TIMEOUT = 5.0
+
+ARRIVAL_SETTLE_FRAMES = 2
+
+# Acknowledged ESP32 commands: how long to wait for an ACK before resending,
+# how many times to resend, and how many commands may be unacknowledged at once
+ACK_TIMEOUT = 0.3
+ACK_RETRIES = 3
+ACK_WINDOW = 4
+ACK_HANDSHAKE = "ACKS,1"
+MAX_SEQUENCE = 9999
+CHASSIS_ACK_WAIT = 5
+
+
+class MotionTimeout(Exception):
+    pass
+
+
+class CommandFailed(Exception):
+    pass
+
+
+class SerialPort:
+    """One serial device with a write queue, incremental line framing and reconnection.
+
+    The reader thread owns the connection: it opens the device, reopens it
+    after an error (a dropped USB cable) and hands every complete line to
+    `on_line`. With `on_frame`, binary frames that start with BINARY_SYNC may
+    be mixed into the stream; text lines never contain that byte. Writes from
+    any thread go through a queue drained by the writer thread, which holds
+    them while the device is away.
+    """
+
+    def __init__(self, name, device, baudrate, on_line=None, on_connect=None, on_frame=None):
+        self.name = name
+        self.device = device
+        self.baudrate = baudrate
+        self.on_line = on_line
+        self.on_connect = on_connect
+        self.on_frame = on_frame
+        self.recorder = None
+        self.connected = threading.Event()
+        self._serial = None
+        self._writes = queue.Queue()
+        self._running = threading.Event()
+        self._reported = False
+
+    def start(self):
+        self._running.set()
+        threading.Thread(target=self._read_loop, name=f"{self.name}-reader", daemon=True).start()
+        threading.Thread(target=self._write_loop, name=f"{self.name}-writer", daemon=True).start()
+
+    def close(self):
+        self._running.clear()
+        self._writes.put(None)
+        self._disconnect()
+
+    def write_line(self, line):
+        self._writes.put(line)
+
+    def _connect(self):
+        try:
+            self._serial = serial.Serial(self.device, self.baudrate, timeout=READ_TIMEOUT, write_timeout=WRITE_TIMEOUT)
+        except (serial.SerialException, OSError) as e:
+            if not self._reported:
+                print(f"Error opening {self.name} on {self.device}: {e}. Retrying...")
+                self._reported = True
+            return None
+        print(f"Connected to {self.name} on {self.device}")
+        self._reported = False
+        self.connected.set()
+        if self.on_connect:
+            self.on_connect()
+        return self._serial
+
+    def _disconnect(self):
+        self.connected.clear()
+        port, self._serial = self._serial, None
+        if port is not None:
+            try:
+                port.close()
+            except (serial.SerialException, OSError):
+                pass
+
+    def _read_loop(self):
+        buffer = bytearray()
+        while self._running.is_set():
+            port = self._serial or self._connect()
+            if port is None:
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+            try:
+                data = port.read(port.in_waiting or 1)
+            except PORT_ERRORS as e:
+                if self._running.is_set():
+                    print(f"Lost {self.name} on {self.device}: {e}")
+                self._disconnect()
+                buffer.clear()
+                continue
+            buffer += data
+            consumed = self._split(buffer)
+            del buffer[:consumed]
+            if len(buffer) > MAX_LINE_LENGTH:
+                # Noise without a line end, e.g. after a baud mismatch
+                buffer.clear()
+
+    def _split(self, buffer):
+        # Hand out every complete line or frame; returns how many bytes were used
+        start = 0
+        while start < len(buffer):
+            end = buffer.find(b"\n", start)
+            sync = buffer.find(BINARY_SYNC, start) if self.on_frame else -1
+            if sync >= 0 and (end < 0 or sync < end):
+                if len(buffer) - sync < BINARY_FRAME.size:
+                    # Wait for the rest of the frame; anything before it is noise
+                    return sync
+                # A corrupt frame loses only its sync byte; the scan resumes after it
+                start = sync + (BINARY_FRAME.size if self.on_frame(buffer, sync) else 1)
+                continue
+            if end < 0:
+                break
+            line = buffer[start:end].decode('utf-8', errors='ignore').strip()
+            start = end + 1
+            if line and self.on_line:
+                self.on_line(line)
+        return start
+
+    def _write_loop(self):
+        while True:
+            line = self._writes.get()
+            if line is None:
+                return
+            while self._running.is_set():
+                port = self._serial
+                if port is None:
+                    self.connected.wait(RECONNECT_INTERVAL)
+                    continue
+                try:
+                    started = time.perf_counter()
+                    port.write((line + '\n').encode('utf-8'))
+                    SERIAL_WRITE.labels(self.name).observe(time.perf_counter() - started)
+                    if self.recorder:
+                        self.recorder.record_event(self.name, "tx", line)
+                    break
+                except PORT_ERRORS as e:
+                    print(f"Error writing to {self.name}: {e}")
+                    # The reader notices the failure too and reconnects
+                    time.sleep(RECONNECT_INTERVAL)
+
+
+class Command:
+    def __init__(self, line):
+        self.line = line
+        self.seq = None
+        self.attempts = 0
+        self.sent_at = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, error=None):
+        self.error = error
+        self.done.set()
+
+
+class CommandChannel:
+    """Sequenced, acknowledged commands to the ESP32 with a send window.
+
+    On every connect the host sends ACKS,1. Firmware that understands it answers
+    ACK,0 and from then on commands go out as `@<seq>,<command>`, each answered
+    with ACK,<seq> or NAK,<seq>,<reason>. Up to `window` commands are in flight
+    at once; the rest wait in order. A command without an answer is resent after
+    `ack_timeout`, up to `retries` times. A resend may run after the firmware
+    already executed the command, so at most one command per axis is in flight
+    and a chassis change is in flight alone: an axis can never be moved back by
+    a late resend, or moved in the wrong chassis mode.
+    Firmware that never answers the handshake gets the plain commands, as before.
+    The handshake is repeated on every connect, since the board may have reset;
+    commands not yet acknowledged by then fail (see check()) instead of being
+    resent out of order with the ones sent after the reconnect.
+    """
+
+    def __init__(self, port, window=ACK_WINDOW, ack_timeout=ACK_TIMEOUT, retries=ACK_RETRIES):
+        self.port = port
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.acknowledged = False
+        self.failed = []
+        self._waiting = []
+        self._outstanding = {}
+        self._sequence = itertools.cycle(range(1, MAX_SEQUENCE + 1))
+        self._lock = threading.Condition()
+        self._running = threading.Event()
+
+    def start(self):
+        self._running.set()
+        threading.Thread(target=self._retransmit_loop, name=f"{self.port.name}-acks", daemon=True).start()
+
+    def close(self):
+        self._running.clear()
+
+    def handshake(self):
+        # Plain commands until the (possibly reset) firmware answers again. Commands
+        # still queued or unanswered fail rather than be resent behind newer ones.
+        with self._lock:
+            self.acknowledged = False
+            for command in list(self._outstanding.values()) + self._waiting:
+                self._fail(command, "connection reset before acknowledgement")
+            self._outstanding.clear()
+            self._waiting = []
+        self.port.write_line(ACK_HANDSHAKE)
+
+    def send(self, line):
+        command = Command(line)
+        with self._lock:
+            if not self.acknowledged:
+                self.port.write_line(line)
+                command.finish()
+                return command
+            self._waiting.append(command)
+            self._fill_window()
+        return command
+
+    def check(self):
+        # Raise for the oldest command the firmware rejected or never acknowledged
+        with self._lock:
+            failed, self.failed = self.failed, []
+        if failed:
+            command = failed[0]
+            raise CommandFailed(f"{self.port.name} command #{command.seq} {command.line} failed: {command.error}")
+
+    def handle_line(self, line):
+        # True if the line was an acknowledgement and is consumed here
+        kind, _, rest = line.partition(",")
+        if kind not in ("ACK", "NAK"):
+            return False
+        seq, _, reason = rest.partition(",")
+        try:
+            seq = int(seq)
+        except ValueError:
+            return False
+        with self._lock:
+            if seq == 0:
+                if not self.acknowledged:
+                    print(f"{self.port.name} acknowledges commands")
+                self.acknowledged = True
+                return True
+            command = self._outstanding.pop(seq, None)
+            if command is None:
+                # Answer to a resend that was already acknowledged
+                return True
+            if kind == "NAK":
+                self._fail(command, reason or "rejected")
+            else:
+                command.finish()
+            self._fill_window()
+        return True
+
+    def _blocked(self, command):
+        # Whether `command` must wait for an outstanding one; see the class docstring
+        if not self._outstanding:
+            return False
+        kind = command.line.partition(",")[0]
+        kinds = {outstanding.line.partition(",")[0] for outstanding in self._outstanding.values()}
+        return kind == "POLO" or "POLO" in kinds or kind in kinds
+
+    def _fill_window(self):
+        # In order: a blocked command holds back everything queued behind it
+        while self._waiting and len(self._outstanding) < self.window and not self._blocked(self._waiting[0]):
+            command = self._waiting.pop(0)
+            command.seq = next(self._sequence)
+            self._outstanding[command.seq] = command
+            self._transmit(command)
+
+    def _transmit(self, command):
+        command.attempts += 1
+        command.sent_at = time.monotonic()
+        self.port.write_line(f"@{command.seq},{command.line}")
+
+    def _fail(self, command, error):
+        print(f"{self.port.name} command #{command.seq} {command.line} failed: {error}")
+        command.finish(error)
+        self.failed.append(command)
+
+    def _retransmit_loop(self):
+        while self._running.is_set():
+            time.sleep(self.ack_timeout / 2)
+            now = time.monotonic()
+            with self._lock:
+                for command in list(self._outstanding.values()):
+                    if now - command.sent_at < self.ack_timeout:
+                        continue
+                    if command.attempts > self.retries:
+                        del self._outstanding[command.seq]
+                        self._fail(command, f"no acknowledgement after {command.attempts} attempts")
+                    elif self.port.connected.is_set():
+                        self._transmit(command)
+                self._fill_window()
+
+
+class RobotLink:
+    """Both boards of the robot: ESP32 motion and telemetry, Nano gripper.
+
+    Targets and the measured position live in `positions`, which also
+    corrects drift once a move settles (see position_manager.py). With a
+    `recorder`, every sample and every line sent or received (other than
+    samples) is recorded instead of printed.
+    """
+
+    def __init__(self, esp32_device=ESP32_PORT, nano_device=ARDUINO_PORT, recorder=None, registry=None):
+        self.recorder = recorder
+        self.telemetry = TelemetryReader(recorder)
+        self.positions = PositionManager(self.telemetry, registry)
+        self.esp32 = SerialPort(
+            "ESP32", esp32_device, BAUD_RATE_ESP, self._esp32_line, self._esp32_connected, self.telemetry.handle_frame,
+        )
+        self.commands = CommandChannel(self.esp32)
+        self.nano = SerialPort("NANO", nano_device, BAUD_RATE_NANO)
+        self.esp32.recorder = self.nano.recorder = recorder
+
+    def start(self):
+        if self.recorder:
+            self.recorder.start()
+        self.commands.start()
+        self.esp32.start()
+        self.nano.start()
+        return self
+
+    def close(self):
+        self.commands.close()
+        self.esp32.close()
+        self.nano.close()
+        if self.recorder:
+            self.recorder.close()
+
+    def _esp32_connected(self):
+        # Firmware without these features ignores the requests and keeps talking text
+        self.commands.handshake()
+        self.esp32.write_line(BINARY_HANDSHAKE)
+
+    def _esp32_line(self, line):
+        if self.commands.handle_line(line) or not self.telemetry.handle_line(line):
+            if self.recorder:
+                self.recorder.record_event(self.esp32.name, "rx", line)
+
+    def _log(self, message):
+        # Console output blocks the caller; with a recorder the lines are on disk anyway
+        if self.recorder is None:
+            print(message)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def initialize_positions(self, timeout=HOMING_TIMEOUT):
+        # Returns the position as soon as the first frame arrives; None if none
+        # does within `timeout`, leaving the default targets in place
+        self.telemetry.wait_for_update(None, timeout)
+        if not self.positions.sync_to_measured():
+            print(f"Failed to initialize positions: no telemetry within {timeout}s. Using default values.")
+            return None
+        initial_data = self.telemetry.latest
+        print(f"Initialized positions - X: {initial_data.x}, Y: {initial_data.y}, Z: {initial_data.z}")
+        return self.positions.target()
+
+    def wait_connected(self, timeout=None):
+        # Both boards connected; False if either is still missing after `timeout`
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for port in (self.esp32, self.nano):
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            if not port.connected.wait(remaining):
+                return False
+        return True
+
+    def send_nano_command(self, command):
+        self.nano.write_line(command)
+        self._log(f"Sent command to Nano: {command}")
+
+    def move_to(self, axis, position):
+        if axis not in AXIS_COMMANDS:
+            print(f"Invalid axis: {axis}")
+            return
+        self._send_move(axis, self.positions.set_target(axis, position))
+
+    def _send_move(self, axis, value):
+        cmd = f"{AXIS_COMMANDS[axis]},{value:.4f}"
+        self.commands.send(cmd)
+        self._log(f"Sent to ESP32: {cmd}")
+
+    def go_to(self, axis, name):
+        # Absolute move to a named rack.json coordinate, e.g. go_to("y", "A1.buffer_y")
+        self.move_to(axis, self.positions.named(name))
+
+    def send_movement_command(self, direction, distance):
+        if direction not in DIRECTIONS:
+            return
+        axis, sign = DIRECTIONS[direction]
+        # Relative to the last target, so stopping a little short does not carry over
+        self.move_to(axis, self.positions.offset_target(axis, sign * distance))
+
+    def change_chassis(self, chassis_command, settle=CHASSIS_SETTLE_TIME):
+        if chassis_command not in CHASSIS_COMMANDS:
+            print(f"Invalid chassis command: {chassis_command}")
+            return
+
+        command = CHASSIS_COMMANDS[chassis_command]
+        sent = self.commands.send(command)
+        self._log(f"Sent chassis command: {command}")
+        # Moves must not start before the switch, so a lost POLO has to surface here
+        if not sent.done.wait(CHASSIS_ACK_WAIT):
+            raise CommandFailed(f"{command}: no acknowledgement within {CHASSIS_ACK_WAIT}s")
+        self.commands.check()
+
+        self._log("Waiting for chassis change to complete...")
+        time.sleep(settle)
+        self._log("Chassis change completed.")
+
+    def wait_for_arrival(self, timeout, tolerance=ARRIVAL_TOLERANCE):
+        # Block until the reported X/Y/Z matches the target, correcting drift once the axes rest
+        target = self.positions.target()
+        deadline = time.monotonic() + timeout
+        arrived = 0
+        corrections_left = MAX_CORRECTIONS
+        snapshot = None
+        while time.monotonic() < deadline:
+            # A rejected or lost move will never arrive; fail now instead of at the deadline
+            self.commands.check()
+            previous = snapshot
+            snapshot = self.telemetry.wait_for_update(previous, deadline - time.monotonic())
+            if snapshot is previous:
+                continue
+            within = all(abs(pos - goal) <= tol for pos, goal, tol in zip(snapshot[:3], target, tolerance))
+            arrived = arrived + 1 if within else 0
+            if previous is not None and at_rest(previous, snapshot):
+                corrections = self.positions.settled(snapshot)
+                if corrections and corrections_left:
+                    for axis, value in corrections.items():
+                        self._send_move(axis, value)
+                    corrections_left -= 1
+                    arrived = 0
+                    continue
+            if arrived >= ARRIVAL_SETTLE_FRAMES:
+                return snapshot
+        raise MotionTimeout(f"Target X: {target[0]}, Y: {target[1]}, Z: {target[2]} not reached within {timeout}s")
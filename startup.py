@@ -0,0 +1,83 @@
+"""Bring the subsystems up in the background while the HTTP server already serves.
+
+Each subsystem's init function runs on its own thread and is retried every
+RETRY_INTERVAL seconds until it returns without raising. `status()` reports
+every subsystem for the readiness endpoint, and `on_ready` runs once all of
+them are up.
+"""
+import threading
+import time
+
+STARTING = "STARTING"
+READY = "READY"
+RETRYING = "RETRYING"
+
+RETRY_INTERVAL = 2.0
+
+
+class Subsystem:
+    def __init__(self, name, init):
+        self.name = name
+        self.init = init
+        self.status = STARTING
+        self.error = None
+        self.attempts = 0
+        self.ready_after = None
+
+    def to_dict(self):
+        return {
+            "status": self.status,
+            "error": self.error,
+            "attempts": self.attempts,
+            "ready_after": self.ready_after,
+        }
+
+
+class Startup:
+    def __init__(self, on_ready=None, retry_interval=RETRY_INTERVAL):
+        self.on_ready = on_ready
+        self.retry_interval = retry_interval
+        self._subsystems = {}
+        self._lock = threading.Lock()
+        self._started = None
+
+    def add(self, name, init):
+        self._subsystems[name] = Subsystem(name, init)
+        return self
+
+    def start(self):
+        self._started = time.monotonic()
+        for subsystem in self._subsystems.values():
+            threading.Thread(target=self._bring_up, args=(subsystem,), name=f"startup-{subsystem.name}", daemon=True).start()
+        return self
+
+    def ready(self):
+        with self._lock:
+            return all(subsystem.status == READY for subsystem in self._subsystems.values())
+
+    def status(self):
+        with self._lock:
+            return {name: subsystem.to_dict() for name, subsystem in self._subsystems.items()}
+
+    def _bring_up(self, subsystem):
+        while True:
+            with self._lock:
+                subsystem.attempts += 1
+            try:
+                subsystem.init()
+                break
+            except Exception as e:
+                print(f"Startup: {subsystem.name} failed (attempt {subsystem.attempts}): {e}")
+                with self._lock:
+                    subsystem.status = RETRYING
+                    subsystem.error = str(e)
+            time.sleep(self.retry_interval)
+        with self._lock:
+            subsystem.status = READY
+            subsystem.error = None
+            subsystem.ready_after = round(time.monotonic() - self._started, 3)
+            # Only the last subsystem to come up sees everything ready
+            all_ready = all(other.status == READY for other in self._subsystems.values())
+        print(f"Startup: {subsystem.name} ready after {subsystem.ready_after}s")
+        if all_ready and self.on_ready:
+            self.on_ready()
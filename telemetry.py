@@ -0,0 +1,122 @@
+import binascii
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from metrics import PARSE_ERRORS, TELEMETRY_FRAMES, TELEMETRY_INTERVAL
+
+# Immutable snapshot of the last AK80 frame. Replacing the reference is atomic,
+# so any thread can read TelemetryReader.latest without taking a lock.
+Position = namedtuple("Position", ["x", "y", "z", "stopped_by_sensor", "timestamp"])
+
+
+# Binary telemetry, enabled when the firmware answers TELB,1 with TELB,OK:
+# sync byte, frame type, X/Y/Z as little-endian float32, flags (bit 0 =
+# stopped by sensor), then CRC-16/CCITT of everything before it. 17 bytes
+# against ~30 for the AK80 line, so about twice the rate at 19200 baud.
+BINARY_HANDSHAKE = "TELB,1"
+BINARY_ACCEPTED = "TELB,OK"
+BINARY_SYNC = 0xAA
+BINARY_POSITION = 0x80
+BINARY_FRAME = struct.Struct("<BBfffBH")
+BINARY_CRC_SPAN = BINARY_FRAME.size - 2
+
+
+def encode_binary_frame(x, y, z, stopped_by_sensor=0):
+    body = struct.pack("<BBfffB", BINARY_SYNC, BINARY_POSITION, x, y, z, stopped_by_sensor & 1)
+    return body + struct.pack("<H", binascii.crc_hqx(body, 0xFFFF))
+
+
+def parse_binary_frame(buffer, offset=0):
+    # `buffer` is the reader's bytearray; the memoryview avoids copying the frame
+    view = memoryview(buffer)[offset:offset + BINARY_FRAME.size]
+    try:
+        sync, kind, x, y, z, flags, crc = BINARY_FRAME.unpack(view)
+        if sync != BINARY_SYNC or kind != BINARY_POSITION:
+            return None
+        if binascii.crc_hqx(view[:BINARY_CRC_SPAN], 0xFFFF) != crc:
+            return None
+        return Position(x, y, z, flags & 1, time.monotonic())
+    finally:
+        view.release()
+
+
+def parse_esp32_data(response):
+    try:
+        if response.startswith("AK80"):
+            parts = response[5:].split(',')
+
+            if len(parts) == 4:  # Expecting 4 parts now (3 positions and the flag)
+                pos_x = round(float(parts[0].strip()), 2)
+                pos_y = round(float(parts[1].strip()), 2)
+                pos_z = round(float(parts[2].strip()), 2)
+                stopped_by_sensor = int(parts[3].strip())  # Parse the flag as an integer
+
+                return Position(pos_x, pos_y, pos_z, stopped_by_sensor, time.monotonic())
+            PARSE_ERRORS.labels("text").inc()
+
+    except ValueError as e:
+        PARSE_ERRORS.labels("text").inc()
+        print(f"Error converting data to float: {e}")
+    except Exception as e:
+        PARSE_ERRORS.labels("text").inc()
+        print(f"Error parsing ESP32 data: {e}")
+    return None
+
+
+class TelemetryReader:
+    """Publishes the latest position from the ESP32 stream.
+
+    Fed AK80 lines or binary frames by the ESP32 port's reader thread.
+    Every sample is also handed to `recorder`, if there is one, and to each
+    callable in `listeners` (on the reader thread, so they must be quick).
+    """
+
+    def __init__(self, recorder=None):
+        self.recorder = recorder
+        self.latest = None
+        self.frames = 0
+        self.binary = False
+        self.listeners = []
+        self._updated = threading.Condition()
+
+    def handle_line(self, line):
+        # True if the line was a position sample
+        if line == BINARY_ACCEPTED:
+            print("ESP32 switched to binary telemetry")
+            self.binary = True
+            return False
+        return self.publish(parse_esp32_data(line), "text")
+
+    def handle_frame(self, buffer, offset):
+        # False if the bytes at `offset` are not a valid frame
+        snapshot = parse_binary_frame(buffer, offset)
+        if snapshot is None:
+            PARSE_ERRORS.labels("binary").inc()
+            return False
+        self.publish(snapshot, "binary")
+        return True
+
+    def publish(self, snapshot, kind):
+        if not snapshot:
+            return False
+        TELEMETRY_FRAMES.labels(kind).inc()
+        if self.latest is not None:
+            TELEMETRY_INTERVAL.observe(snapshot.timestamp - self.latest.timestamp)
+        self.latest = snapshot
+        self.frames += 1
+        if self.recorder:
+            self.recorder.record_sample(snapshot)
+        for listener in self.listeners:
+            listener(snapshot)
+        with self._updated:
+            self._updated.notify_all()
+        return True
+
+    def wait_for_update(self, previous=None, timeout=None):
+        # Block until a snapshot newer than `previous` is published; returns
+        # `previous` unchanged if the timeout runs out first
+        with self._updated:
+            self._updated.wait_for(lambda: self.latest is not previous, timeout)
+        return self.latest